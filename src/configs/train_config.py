@@ -11,6 +11,36 @@ class RenderConfig:
     train_grid_size: int = 1200
     # Grid size of evaluation
     eval_grid_size: int = 1024
+    # Number of views rasterized together in batched renders
+    view_batch_size: int = 8
+    # Memory budget of the per-view G-buffer cache, in MB. The cached G-buffers stay on the render device,
+    # 0 turns the cache off
+    gbuffer_cache_mb: int = 0
+    # Store the depth and normals of cached G-buffers in half precision, uvs are always kept in full precision
+    gbuffer_cache_half: bool = False
+    # Persist G-buffers of rendered views under the shape cache dir, to be reused by later runs
+    disk_gbuffer_cache: bool = False
+    # Rasterize and shade in square screen tiles of this size, to bound memory on large grids
+    render_tile_size: Optional[int] = None
+    # Cull back facing and off screen faces before rasterizing, needs consistently oriented faces
+    cull_faces: bool = False
+    # Rasterize only the object's projected bounding box during painting, directly at crop_render_size
+    crop_adaptive: bool = False
+    # Render resolution of the object crop, the diffusion model works at 512
+    crop_render_size: int = 512
+    # Rasterizer backend, 'kaolin' (CUDA) or 'torch' (pure PyTorch, also runs on CPU)
+    rasterizer: str = 'kaolin'
+    # Vertex clustering grid sizes of the decimated levels of detail 1, 2, ... (0 is the full mesh)
+    lod_grid_sizes: List[int] = field(default_factory=[256, 128, 64].copy)
+    # Level of detail used for the evaluation renders during painting
+    eval_lod: int = 0
+    # Level of detail used for the final video renders
+    video_lod: int = 0
+    # Large mesh mode for multi-million face meshes: int32 indices, no dense per face uvs,
+    # faces projected and rasterized in chunks of large_mesh_chunk_size
+    large_mesh: bool = False
+    # Faces per chunk in large mesh mode
+    large_mesh_chunk_size: int = 2 ** 20
     # training camera radius range
     radius: float = 1.5
     # Set [0,overhead_range] as the overhead region
@@ -69,6 +99,19 @@ class GuideConfig:
     z_update_thr: float = 0.2
     # Some more strict masking for projecting back
     strict_projection: bool = True
+    # Eigensolver of the spectral augmentations: 'shift_invert' (exact, scipy eigsh), 'lobpcg' (approximate,
+    # torch block LOBPCG, no factorization) or 'auto' (lobpcg above eigen_lobpcg_threshold vertices)
+    eigen_solver: str = 'auto'
+    # Vertex count above which the 'auto' eigensolver switches to lobpcg
+    eigen_lobpcg_threshold: int = 200000
+    # Tolerance of the eigensolver
+    eigen_tol: float = 1e-3
+    # Number of precomputed augmented vertex sets renders sample from, 0 deforms the mesh on every render instead
+    augmentation_bank_size: int = 32
+    # Unwrap the disconnected parts of the mesh in parallel worker processes and pack them into one atlas
+    parallel_unwrap: bool = False
+    # Worker processes of the parallel unwrap, all cores when None
+    unwrap_workers: Optional[int] = None
 
 
 @dataclass
@@ -84,6 +127,9 @@ class OptimConfig:
     max_timestep: float = 0.98
     # For Diffusion model
     no_noise: bool = False
+    # Project back by optimizing only the texels seen by the updated pixels, instead of the full texture maps.
+    # Not available with bicubic texture interpolation
+    sparse_projection: bool = False
 
 
 @dataclass
@@ -103,6 +149,8 @@ class LogConfig:
     full_eval_size: int = 100
     # Export a mesh
     save_mesh: bool = True
+    # Also export the mesh as a binary glTF (mesh.glb) with the texture embedded
+    save_glb: bool = False
     # Whether to show intermediate diffusion visualizations
     vis_diffusion_steps: bool = False
     # Whether to log intermediate images
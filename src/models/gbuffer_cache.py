@@ -0,0 +1,85 @@
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+import torch
+
+
+def split_render_cache(render_cache: Dict[str, Any]) -> List[Dict[str, Any]]:
+    # batched render cache -> one render cache per view
+    n_views = render_cache['face_idx'].shape[0]
+    return [{key: value[i:i + 1] if isinstance(value, torch.Tensor) else value
+             for key, value in render_cache.items()} for i in range(n_views)]
+
+
+def cat_render_caches(render_caches: List[Dict[str, Any]]) -> Dict[str, Any]:
+    # per view render caches -> one batched render cache, with the tensors present in all of them
+    # (views from the cache, the disk or a fresh rasterization may not carry the same optional keys)
+    if len(render_caches) == 1:
+        return render_caches[0]
+    keys = [key for key, value in render_caches[0].items() if isinstance(value, torch.Tensor)
+            and all(isinstance(render_cache.get(key), torch.Tensor) for render_cache in render_caches[1:])]
+    return {key: torch.cat([render_cache[key] for render_cache in render_caches], dim=0) for key in keys}
+
+
+class GBufferCache:
+    # LRU cache of per-view render caches (uv_features, face_idx, depth, normals), bounded by their size in bytes.
+    # With half_precision only the HALF_PRECISION_KEYS buffers are halved, fp16 uvs are off by up to half a texel
+    HALF_PRECISION_KEYS = ('depth_map', 'face_normals', 'normals_image', 'z_normals_image')
+
+    def __init__(self, max_bytes: int = 0, half_precision: bool = False):
+        self.max_bytes = max_bytes
+        self.half_precision = half_precision
+        self.n_bytes = 0
+        self._entries = OrderedDict()
+
+    @staticmethod
+    def view_key(theta, phi, radius, dims: Tuple[int, int], lod: int = 0, window=None) -> Tuple:
+        window = None if window is None else tuple(round(float(w), 6) for w in window)
+        return round(float(theta), 6), round(float(phi), 6), round(float(radius), 6), tuple(dims), lod, window
+
+    @staticmethod
+    def _n_bytes(entry: Dict[str, torch.Tensor]) -> int:
+        return sum(value.element_size() * value.nelement() for value in entry.values())
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key) -> Optional[Dict[str, torch.Tensor]]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        self._entries.move_to_end(key)
+        return {name: value.float() if value.is_floating_point() else value for name, value in entry.items()}
+
+    def put(self, key, render_cache: Dict[str, Any]):
+        if self.max_bytes <= 0:
+            return
+        if key in self._entries:
+            self.n_bytes -= self._n_bytes(self._entries.pop(key))
+
+        entry = {}
+        for name, value in render_cache.items():
+            if not isinstance(value, torch.Tensor):
+                continue
+            value = value.detach()
+            # copy, so that slices of batched renders do not keep the whole batch alive
+            if self.half_precision and name in self.HALF_PRECISION_KEYS:
+                entry[name] = value.half()
+            else:
+                entry[name] = value.clone()
+
+        n_bytes = self._n_bytes(entry)
+        if n_bytes > self.max_bytes:
+            return
+        self._entries[key] = entry
+        self.n_bytes += n_bytes
+        while self.n_bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.n_bytes -= self._n_bytes(evicted)
+
+    def clear(self):
+        self._entries.clear()
+        self.n_bytes = 0
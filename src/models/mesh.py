@@ -1,34 +1,73 @@
 import kaolin as kal
 import torch
+from loguru import logger
 
 import copy
 
+from . import mesh_io
+
 class Mesh:
-    def __init__(self,obj_path, device):
+    def __init__(self,obj_path, device, index_dtype=torch.long):
         # from https://github.com/threedle/text2mesh
+        # index_dtype=torch.int32 halves the memory of faces and ft on large meshes
 
-        if ".obj" in obj_path:
-            try:
-                mesh = kal.io.obj.import_mesh(obj_path, with_normals=True, with_materials=True)
-            except:
-                mesh = kal.io.obj.import_mesh(obj_path, with_normals=True, with_materials=False)
+        # parsed meshes are kept in a binary sidecar next to the mesh file, later loads memory map it
+        arrays = mesh_io.load_mesh_cache(obj_path)
+        if arrays is None:
+            arrays = self.import_arrays(obj_path)
+            mesh_io.save_mesh_cache(obj_path, arrays)
 
+        self.vertices = torch.from_numpy(arrays['vertices']).to(device)
+        self.faces = torch.from_numpy(arrays['faces']).to(device, index_dtype)
+        # per face normals and areas are computed on first use
+        self._normals, self._face_area = None, None
+        self.ft = torch.from_numpy(arrays['face_uvs_idx']).to(index_dtype) if 'face_uvs_idx' in arrays else None
+        self.vt = torch.from_numpy(arrays['uvs']) if 'uvs' in arrays else None
+
+    @staticmethod
+    def import_arrays(obj_path):
+        # vertices, faces, uvs and face_uvs_idx of the mesh file as numpy arrays, uvs may be missing.
+        # The numpy readers are tried first, kaolin's importers handle what they cannot
+        try:
+            return mesh_io.read_mesh(obj_path)
+        except ValueError as e:
+            logger.info(f'falling back to the kaolin mesh importer: {e}')
+
+        if ".obj" in obj_path:
+            # with_materials is needed for kaolin to read vt and the face uv indices, missing or broken materials
+            # are skipped instead of failing the import
+            mesh = kal.io.obj.import_mesh(obj_path, with_normals=True, with_materials=True,
+                                          error_handler=kal.io.obj.skip_error)
         elif ".off" in obj_path:
             mesh = kal.io.off.import_mesh(obj_path)
         else:
             raise ValueError(f"{obj_path} extension not implemented in mesh reader.")
 
-        self.vertices = mesh.vertices.to(device)
-        self.faces = mesh.faces.to(device)
-        self.normals, self.face_area = self.calculate_face_normals(self.vertices, self.faces)
-        self.ft = mesh.face_uvs_idx
-        self.vt = mesh.uvs
+        arrays = {'vertices': mesh.vertices.float().numpy(), 'faces': mesh.faces.long().numpy()}
+        uvs, face_uvs_idx = getattr(mesh, 'uvs', None), getattr(mesh, 'face_uvs_idx', None)
+        if uvs is not None and face_uvs_idx is not None:
+            arrays['uvs'] = uvs.float().numpy()
+            arrays['face_uvs_idx'] = face_uvs_idx.long().numpy()
+        return arrays
+
+    @property
+    def normals(self):
+        if self._normals is None:
+            self._normals, self._face_area = self.calculate_face_normals(self.vertices, self.faces)
+        return self._normals
+
+    @property
+    def face_area(self):
+        if self._face_area is None:
+            self._normals, self._face_area = self.calculate_face_normals(self.vertices, self.faces)
+        return self._face_area
 
     @staticmethod
     def calculate_face_normals(vertices: torch.Tensor, faces: torch.Tensor):
         """
         calculate per face normals from vertices and faces
         """
+        faces = faces.long()
         v0 = vertices[faces[:, 0]]
         v1 = vertices[faces[:, 1]]
         v2 = vertices[faces[:, 2]]
@@ -39,6 +78,36 @@ class Mesh:
         n = n / twice_area[:, None]
         return n, twice_area / 2
 
+    def decimate(self, grid_size: int):
+        """
+        vertex clustering decimation on a grid_size^3 grid, returns the decimated mesh and the indices of the kept faces.
+        Kept faces keep their uv indices, so the decimated mesh samples the same texture
+        """
+        lod = copy.copy(self)
+
+        vertices = self.vertices
+        min_corner = vertices.min(dim=0)[0]
+        extent = (vertices.max(dim=0)[0] - min_corner).max()
+        cells = ((vertices - min_corner) / extent * (grid_size - 1)).round().long()
+        cell_keys = (cells[:, 0] * grid_size + cells[:, 1]) * grid_size + cells[:, 2]
+        _, vertex_cluster = torch.unique(cell_keys, return_inverse=True)
+
+        # each cluster is represented by the mean of its vertices
+        n_clusters = int(vertex_cluster.max()) + 1
+        counts = torch.zeros(n_clusters, device=vertices.device).index_add_(
+            0, vertex_cluster, torch.ones_like(vertices[:, 0]))
+        lod.vertices = torch.zeros(n_clusters, 3, device=vertices.device).index_add_(
+            0, vertex_cluster, vertices) / counts[:, None]
+
+        faces = vertex_cluster[self.faces.long()]
+        kept = (faces[:, 0] != faces[:, 1]) & (faces[:, 1] != faces[:, 2]) & (faces[:, 0] != faces[:, 2])
+        face_indices = kept.nonzero()[:, 0]
+        lod.faces = faces[face_indices].to(self.faces.dtype)
+        lod._normals, lod._face_area = None, None
+        if self.ft is not None:
+            lod.ft = self.ft[face_indices.to(self.ft.device)]
+        return lod, face_indices
+
     def standardize_mesh(self,inplace=False):
         mesh = self if inplace else copy.deepcopy(self)
 
@@ -48,6 +117,7 @@ class Mesh:
         scale = torch.std(torch.norm(verts, p=2, dim=1))
         verts /= scale
         mesh.vertices = verts
+        mesh._normals, mesh._face_area = None, None
         return mesh
 
     def normalize_mesh(self,inplace=False, target_scale=1, dy=0):
@@ -61,5 +131,6 @@ class Mesh:
         verts *= target_scale
         verts[:, 1] += dy
         mesh.vertices = verts
+        mesh._normals, mesh._face_area = None, None
         return mesh
 
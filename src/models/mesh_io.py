@@ -0,0 +1,455 @@
+import hashlib
+import itertools
+import json
+import os
+import struct
+
+import numpy as np
+
+from src import utils
+
+GLB_MAGIC = 0x46546C67
+GLB_JSON_CHUNK = 0x4E4F534A
+GLB_BIN_CHUNK = 0x004E4942
+
+MESH_CACHE_MAGIC = b'TXMESH01'
+MESH_CACHE_ALIGNMENT = 64
+
+
+def _write_rows(fp, row_format: str, rows: np.ndarray, chunk_size: int):
+    # formats chunk_size rows at once with a single % on a repeated row format
+    for start in range(0, rows.shape[0], chunk_size):
+        chunk = rows[start:start + chunk_size]
+        fp.write((row_format * chunk.shape[0]) % tuple(chunk.ravel().tolist()))
+
+
+def write_obj(obj_path, vertices: np.ndarray, vt: np.ndarray, faces: np.ndarray, ft: np.ndarray,
+              mtl_name: str = None, chunk_size: int = 2 ** 16):
+    # obj with v, vt and f v/vt lines, written in bulk
+    with open(obj_path, 'w') as fp:
+        if mtl_name is not None:
+            fp.write(f'mtllib {mtl_name} \n')
+        _write_rows(fp, 'v %.9g %.9g %.9g \n', vertices, chunk_size)
+        _write_rows(fp, 'vt %.9g %.9g \n', vt, chunk_size)
+        if mtl_name is not None:
+            fp.write('usemtl mat0 \n')
+        corners = np.stack([faces.astype(np.int64) + 1, ft.astype(np.int64) + 1], axis=-1).reshape(-1, 6)
+        _write_rows(fp, 'f %d/%d %d/%d %d/%d \n', corners, chunk_size)
+
+
+def _padded(data: bytes, pad: bytes = b'\0') -> bytes:
+    return data + pad * (-len(data) % 4)
+
+
+def write_glb(glb_path, vertices: np.ndarray, vt: np.ndarray, faces: np.ndarray, ft: np.ndarray,
+              texture_png: bytes):
+    # binary glTF with a single textured primitive, texture_png is embedded as the base color texture.
+    # glTF has one uv per vertex, so every distinct (vertex, uv) pair of the face corners becomes a glTF vertex
+    corner_keys = faces.astype(np.int64).reshape(-1) * vt.shape[0] + ft.astype(np.int64).reshape(-1)
+    pair_keys, indices = np.unique(corner_keys, return_inverse=True)
+    positions = vertices[pair_keys // vt.shape[0]].astype('<f4')
+    uvs = vt[pair_keys % vt.shape[0]].astype('<f4')
+    # the glTF uv origin is the top left corner of the image
+    uvs[:, 1] = 1 - uvs[:, 1]
+    indices = indices.reshape(-1).astype('<u4')
+
+    views = [indices.tobytes(), positions.tobytes(), uvs.tobytes(), texture_png]
+    buffer_views, offset = [], 0
+    for i, view in enumerate(views):
+        buffer_view = {'buffer': 0, 'byteOffset': offset, 'byteLength': len(view)}
+        if i < 3:
+            buffer_view['target'] = 34963 if i == 0 else 34962
+        buffer_views.append(buffer_view)
+        offset += len(_padded(view))
+    binary = b''.join(_padded(view) for view in views)
+
+    gltf = {
+        'asset': {'version': '2.0'},
+        'scene': 0,
+        'scenes': [{'nodes': [0]}],
+        'nodes': [{'mesh': 0}],
+        'meshes': [{'primitives': [{'attributes': {'POSITION': 1, 'TEXCOORD_0': 2}, 'indices': 0, 'material': 0}]}],
+        'materials': [{'pbrMetallicRoughness': {'baseColorTexture': {'index': 0}, 'metallicFactor': 0.0,
+                                                'roughnessFactor': 1.0}}],
+        'textures': [{'source': 0, 'sampler': 0}],
+        'samplers': [{'magFilter': 9729, 'minFilter': 9987}],
+        'images': [{'bufferView': 3, 'mimeType': 'image/png'}],
+        'accessors': [
+            {'bufferView': 0, 'componentType': 5125, 'count': int(indices.shape[0]), 'type': 'SCALAR'},
+            {'bufferView': 1, 'componentType': 5126, 'count': int(positions.shape[0]), 'type': 'VEC3',
+             'min': positions.min(axis=0).tolist(), 'max': positions.max(axis=0).tolist()},
+            {'bufferView': 2, 'componentType': 5126, 'count': int(uvs.shape[0]), 'type': 'VEC2'},
+        ],
+        'bufferViews': buffer_views,
+        'buffers': [{'byteLength': len(binary)}],
+    }
+    json_chunk = _padded(json.dumps(gltf, separators=(',', ':')).encode(), b' ')
+
+    with open(glb_path, 'wb') as fp:
+        fp.write(struct.pack('<III', GLB_MAGIC, 2, 12 + 8 + len(json_chunk) + 8 + len(binary)))
+        fp.write(struct.pack('<II', len(json_chunk), GLB_JSON_CHUNK))
+        fp.write(json_chunk)
+        fp.write(struct.pack('<II', len(binary), GLB_BIN_CHUNK))
+        fp.write(binary)
+
+
+def source_signature(path, sample_bytes: int = 2 ** 20) -> dict:
+    # cheap identity of a mesh file: size, modification time and a hash of its first and last sample_bytes
+    stat = os.stat(path)
+    digest = hashlib.sha1()
+    with open(path, 'rb') as fp:
+        digest.update(fp.read(sample_bytes))
+        if stat.st_size > sample_bytes:
+            fp.seek(max(stat.st_size - sample_bytes, sample_bytes))
+            digest.update(fp.read())
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha1': digest.hexdigest()}
+
+
+def mesh_cache_path(path) -> str:
+    return f'{path}.meshcache'
+
+
+def save_mesh_cache(path, arrays: dict):
+    # binary sidecar of the mesh file: magic, header length, json header (source signature, dtype, shape and offset
+    # of every array), then the raw arrays, each aligned to MESH_CACHE_ALIGNMENT bytes
+    arrays = {name: np.ascontiguousarray(array) for name, array in arrays.items() if array is not None}
+    header = {'source': source_signature(path), 'arrays': {}}
+    # the offsets depend on the header length, grow the reserved header size until it fits
+    header_size = MESH_CACHE_ALIGNMENT
+    while True:
+        offset = header_size
+        for name, array in arrays.items():
+            header['arrays'][name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+            offset += -(-array.nbytes // MESH_CACHE_ALIGNMENT) * MESH_CACHE_ALIGNMENT
+        header_bytes = json.dumps(header).encode()
+        if len(MESH_CACHE_MAGIC) + 4 + len(header_bytes) <= header_size:
+            break
+        header_size *= 2
+
+    def write(tmp_path):
+        with open(tmp_path, 'wb') as fp:
+            fp.write(MESH_CACHE_MAGIC + struct.pack('<I', len(header_bytes)) + header_bytes)
+            for name, array in arrays.items():
+                fp.seek(header['arrays'][name]['offset'])
+                fp.write(array.tobytes())
+
+    utils.atomic_write(mesh_cache_path(path), write)
+
+
+def load_mesh_cache(path):
+    # memory mapped arrays of the sidecar of the mesh file, None when missing or stale
+    cache_path = mesh_cache_path(path)
+    if not os.path.exists(cache_path):
+        return None
+    with open(cache_path, 'rb') as fp:
+        if fp.read(len(MESH_CACHE_MAGIC)) != MESH_CACHE_MAGIC:
+            return None
+        header_length, = struct.unpack('<I', fp.read(4))
+        header = json.loads(fp.read(header_length))
+    if header['source'] != source_signature(path):
+        return None
+    # mapped copy-on-write, empty arrays cannot be mapped
+    return {name: np.memmap(cache_path, dtype=np.dtype(array['dtype']), mode='c', offset=array['offset'],
+                            shape=tuple(array['shape'])) if np.prod(array['shape']) > 0
+            else np.empty(array['shape'], dtype=np.dtype(array['dtype']))
+            for name, array in header['arrays'].items()}
+
+
+PLY_TYPES = {'char': 'i1', 'int8': 'i1', 'uchar': 'u1', 'uint8': 'u1', 'short': 'i2', 'int16': 'i2',
+             'ushort': 'u2', 'uint16': 'u2', 'int': 'i4', 'int32': 'i4', 'uint': 'u4', 'uint32': 'u4',
+             'float': 'f4', 'float32': 'f4', 'double': 'f8', 'float64': 'f8'}
+
+
+def read_mesh(path, chunk_bytes: int = 2 ** 26) -> dict:
+    # vertices, faces and, when the file has them, uvs and face_uvs_idx as numpy arrays, polygons are triangulated.
+    # Raises ValueError on files the readers do not handle
+    extension = os.path.splitext(str(path))[1].lower()
+    if extension == '.obj':
+        arrays = read_obj(path, chunk_bytes)
+    elif extension == '.off':
+        arrays = read_off(path)
+    elif extension == '.ply':
+        arrays = read_ply(path)
+    else:
+        raise ValueError(f'{path} extension not implemented in mesh reader.')
+
+    # out of range indices would only fail later on device, reject them so that kaolin gets a try
+    for indices, values, name in [(arrays['faces'], arrays['vertices'], 'faces'),
+                                  (arrays.get('face_uvs_idx'), arrays.get('uvs'), 'face_uvs_idx')]:
+        if indices is not None and indices.size > 0 and (indices.min() < 0 or indices.max() >= values.shape[0]):
+            raise ValueError(f'{path}: {name} index out of range')
+    return arrays
+
+
+def fan_triangulate(corners: np.ndarray, counts: np.ndarray) -> np.ndarray:
+    # triangles [T, 3, ...] of the polygons whose corners are concatenated in corners [sum(counts), ...],
+    # as fans around their first corner. Polygons with less than 3 corners are dropped
+    starts = np.cumsum(counts) - counts
+    n_triangles = np.maximum(counts - 2, 0)
+    polygon = np.repeat(np.arange(counts.shape[0]), n_triangles)
+    first_triangle = np.cumsum(n_triangles) - n_triangles
+    local = np.arange(n_triangles.sum()) - np.repeat(first_triangle, n_triangles) + 1
+    first = starts[polygon]
+    return np.stack([corners[first], corners[first + local], corners[first + local + 1]], axis=1)
+
+
+def _line_token_counts(text: str, n_lines: int) -> np.ndarray:
+    # number of whitespace separated tokens on each newline terminated line of text
+    chars = np.frombuffer(text.encode(), dtype=np.uint8)
+    newline = chars == ord('\n')
+    space = newline | (chars == ord(' ')) | (chars == ord('\t')) | (chars == ord('\r'))
+    token_start = ~space & np.concatenate([[True], space[:-1]])
+    line = np.cumsum(newline) - newline
+    return np.bincount(line[token_start], minlength=n_lines)[:n_lines]
+
+
+def _parse_rows(lines, n_columns: int, dtype) -> np.ndarray:
+    # first n_columns numbers of every line, parsed in bulk when all lines have the same number of tokens
+    text = ''.join(line if line.endswith('\n') else line + '\n' for line in lines)
+    tokens = _line_token_counts(text, len(lines))
+    if tokens.min() < n_columns:
+        raise ValueError(f'line with less than {n_columns} values')
+    if (tokens == tokens[0]).all():
+        values = np.fromstring(text, dtype=dtype, sep=' ')
+        if values.shape[0] == tokens.sum():
+            return values.reshape(len(lines), -1)[:, :n_columns]
+    return np.array([line.split()[:n_columns] for line in lines], dtype=dtype)
+
+
+def read_obj(path, chunk_bytes: int = 2 ** 26) -> dict:
+    # streams the file chunk_bytes at a time, every chunk is parsed with bulk numpy conversions
+    vertices, uvs, corner_v, corner_vt, counts = [], [], [], [], []
+    with open(path, 'r') as fp:
+        while True:
+            lines = fp.readlines(chunk_bytes)
+            if len(lines) == 0:
+                break
+            # the keyword may be indented and followed by any whitespace
+            v_lines, vt_lines, f_tokens = [], [], []
+            for line in lines:
+                words = line.split(maxsplit=1)
+                if len(words) < 2:
+                    continue
+                if words[0] == 'v':
+                    v_lines.append(words[1])
+                elif words[0] == 'vt':
+                    vt_lines.append(words[1])
+                elif words[0] == 'f':
+                    f_tokens.append(words[1].split())
+            if len(v_lines) > 0:
+                vertices.append(_parse_rows(v_lines, 3, np.float32))
+            if len(vt_lines) > 0:
+                uvs.append(_parse_rows(vt_lines, 2, np.float32))
+            if len(f_tokens) == 0:
+                continue
+
+            # corners are v, v/vt, v/vt/vn or v//vn, the whole file is expected to use one of them
+            first_corner = f_tokens[0][0]
+            n_fields = first_corner.count('/') + 1
+            corners_text = ' '.join(' '.join(tokens) for tokens in f_tokens).replace('//', '/0/').replace('/', ' ')
+            corners = np.fromstring(corners_text, dtype=np.int64, sep=' ')
+            chunk_counts = np.array([len(tokens) for tokens in f_tokens])
+            if corners.shape[0] != chunk_counts.sum() * n_fields:
+                raise ValueError(f'{path} mixes face formats')
+            corners = corners.reshape(-1, n_fields)
+            if (corners[:, 0] < 0).any():
+                raise ValueError(f'{path} uses relative indices')
+            counts.append(chunk_counts)
+            corner_v.append(corners[:, 0] - 1)
+            if n_fields > 1 and '//' not in first_corner:
+                corner_vt.append(corners[:, 1] - 1)
+
+    if len(vertices) == 0 or len(counts) == 0:
+        raise ValueError(f'{path} has no vertices or faces')
+    counts = np.concatenate(counts)
+    arrays = {'vertices': np.concatenate(vertices), 'faces': fan_triangulate(np.concatenate(corner_v), counts)}
+    if len(uvs) > 0 and len(corner_vt) == len(corner_v):
+        arrays['uvs'] = np.concatenate(uvs)
+        arrays['face_uvs_idx'] = fan_triangulate(np.concatenate(corner_vt), counts)
+    return arrays
+
+
+def read_off(path) -> dict:
+    with open(path, 'r') as fp:
+        lines = [line.split('#')[0] for line in fp]
+    lines = [line for line in lines if line.strip()]
+    header = lines[0].split()
+    if not header[0].endswith('OFF'):
+        raise ValueError(f'{path} is not an off file')
+    # the counts may follow the keyword on the same line
+    if len(header) > 1:
+        n_vertices, n_faces = int(header[1]), int(header[2])
+        start = 1
+    else:
+        n_vertices, n_faces = [int(count) for count in lines[1].split()[:2]]
+        start = 2
+
+    if n_vertices == 0 or n_faces == 0:
+        raise ValueError(f'{path} has no vertices or faces')
+    vertices = _parse_rows(lines[start:start + n_vertices], 3, np.float32)
+    face_lines = lines[start + n_vertices:start + n_vertices + n_faces]
+    rows = np.fromstring(''.join(face_lines), dtype=np.int64, sep=' ')
+    if rows.shape[0] % n_faces == 0 and (rows.reshape(n_faces, -1)[:, 0] == rows[0]).all():
+        # every face has the same corner count, possibly followed by colors
+        rows = rows.reshape(n_faces, -1)
+        counts = rows[:, 0]
+        corners = rows[:, 1:1 + rows[0, 0]].reshape(-1)
+    else:
+        rows = [line.split() for line in face_lines]
+        counts = np.array([int(row[0]) for row in rows])
+        corners = np.array([int(index) for row, count in zip(rows, counts) for index in row[1:1 + count]],
+                           dtype=np.int64)
+    return {'vertices': vertices, 'faces': fan_triangulate(corners, counts)}
+
+
+def _read_ply_binary_element(fp, count: int, properties, endian: str):
+    # {property: values} of a binary element read from fp.
+    # List properties are [count, length] arrays when all lists of the element have the same length, read in bulk,
+    # lists of arrays otherwise
+    start = fp.tell()
+    # the list lengths of the first record give the record layout
+    fields = []
+    for name, property_type in properties:
+        if isinstance(property_type, tuple):
+            _, count_type, item_type = property_type
+            length = int(np.frombuffer(fp.read(np.dtype(count_type).itemsize), endian + count_type)[0]) \
+                if count > 0 else 0
+            fp.seek(length * np.dtype(item_type).itemsize, os.SEEK_CUR)
+            fields += [(f'{name}_length', endian + count_type), (name, endian + item_type, (length,))]
+        else:
+            fields.append((name, endian + property_type))
+            fp.seek(np.dtype(property_type).itemsize, os.SEEK_CUR)
+    dtype = np.dtype(fields)
+    fp.seek(start)
+    data = fp.read(dtype.itemsize * count)
+    if len(data) == dtype.itemsize * count:
+        records = np.frombuffer(data, dtype, count)
+        list_names = [name for name, property_type in properties if isinstance(property_type, tuple)]
+        if all((records[f'{name}_length'] == dtype[name].shape[0]).all() for name in list_names):
+            return {name: records[name] for name, _ in properties}
+
+    # lists of varying length, records are walked one by one
+    fp.seek(start)
+    values = {name: [] for name, _ in properties}
+    for _ in range(count):
+        for name, property_type in properties:
+            if isinstance(property_type, tuple):
+                _, count_type, item_type = property_type
+                length = int(np.frombuffer(fp.read(np.dtype(count_type).itemsize), endian + count_type)[0])
+                values[name].append(np.frombuffer(fp.read(length * np.dtype(item_type).itemsize),
+                                                  endian + item_type, length))
+            else:
+                values[name].append(np.frombuffer(fp.read(np.dtype(property_type).itemsize),
+                                                  endian + property_type)[0])
+    return values
+
+
+def _read_ply_ascii_element(fp, count: int, properties):
+    # {property: values} of an ascii element, one record per line, same layout as _read_ply_binary_element
+    lines = [line.decode('ascii') for line in itertools.islice(fp, count)]
+    if len(lines) < count:
+        raise ValueError('ply element is truncated')
+    if count == 0:
+        return {name: np.zeros((0,) if not isinstance(property_type, tuple) else (0, 0), dtype=np.float64)
+                for name, property_type in properties}
+
+    text = ''.join(line if line.endswith('\n') else line + '\n' for line in lines)
+    tokens = _line_token_counts(text, count)
+    if (tokens == tokens[0]).all():
+        rows = np.fromstring(text, dtype=np.float64, sep=' ')
+        if rows.shape[0] == tokens.sum():
+            rows = rows.reshape(count, -1)
+            values, column = {}, 0
+            for name, property_type in properties:
+                if isinstance(property_type, tuple):
+                    _, count_type, item_type = property_type
+                    lengths = rows[:, column]
+                    if not (lengths == lengths[0]).all():
+                        break
+                    values[name] = rows[:, column + 1:column + 1 + int(lengths[0])].astype(item_type)
+                    column += 1 + int(lengths[0])
+                else:
+                    values[name] = rows[:, column].astype(property_type)
+                    column += 1
+            else:
+                return values
+
+    # lists of varying length, records are walked one by one
+    values = {name: [] for name, _ in properties}
+    for line in lines:
+        row, column = line.split(), 0
+        for name, property_type in properties:
+            if isinstance(property_type, tuple):
+                _, count_type, item_type = property_type
+                length = int(row[column])
+                values[name].append(np.array(row[column + 1:column + 1 + length], dtype=np.float64).astype(item_type))
+                column += 1 + length
+            else:
+                values[name].append(float(row[column]))
+                column += 1
+    return values
+
+
+def read_ply(path) -> dict:
+    # ascii or binary little / big endian ply with a vertex and a face element, per vertex (s, t / u, v / texture_u,
+    # texture_v) or per face (texcoord) uvs are read when present. Elements are streamed from the file one at a time
+    with open(path, 'rb') as fp:
+        if fp.readline().strip() != b'ply':
+            raise ValueError(f'{path} is not a ply file')
+        ply_format, elements = None, []
+        while True:
+            line = fp.readline()
+            if not line:
+                raise ValueError(f'{path} has no end_header')
+            words = line.decode('ascii', errors='replace').split()
+            if len(words) == 0 or words[0] in ['comment', 'obj_info']:
+                continue
+            if words[0] == 'format':
+                ply_format = words[1]
+            elif words[0] == 'element':
+                elements.append((words[1], int(words[2]), []))
+            elif words[0] == 'property' and words[1] == 'list':
+                elements[-1][2].append((words[4], ('list', PLY_TYPES[words[2]], PLY_TYPES[words[3]])))
+            elif words[0] == 'property':
+                elements[-1][2].append((words[2], PLY_TYPES[words[1]]))
+            elif words[0] == 'end_header':
+                break
+        if ply_format not in ['ascii', 'binary_little_endian', 'binary_big_endian']:
+            raise ValueError(f'{path}: ply format {ply_format} not supported')
+
+        endian = '<' if ply_format == 'binary_little_endian' else '>'
+        values = {}
+        for name, count, properties in elements:
+            if ply_format == 'ascii':
+                values[name] = _read_ply_ascii_element(fp, count, properties)
+            else:
+                values[name] = _read_ply_binary_element(fp, count, properties, endian)
+            # nothing after the faces is used
+            if 'vertex' in values and 'face' in values:
+                break
+    if 'vertex' not in values or 'face' not in values:
+        raise ValueError(f'{path} has no vertex or face element')
+
+    vertex, face = values['vertex'], values['face']
+    arrays = {'vertices': np.stack([np.asarray(vertex[axis], dtype=np.float32) for axis in 'xyz'], axis=1)}
+    index_name = 'vertex_indices' if 'vertex_indices' in face else 'vertex_index'
+    indices = face[index_name]
+    if isinstance(indices, np.ndarray):
+        counts = np.full(indices.shape[0], indices.shape[1])
+        corners = indices.reshape(-1).astype(np.int64)
+    else:
+        counts = np.array([face_indices.shape[0] for face_indices in indices])
+        corners = np.concatenate(indices).astype(np.int64)
+    arrays['faces'] = fan_triangulate(corners, counts)
+
+    for u, v in [('s', 't'), ('u', 'v'), ('texture_u', 'texture_v')]:
+        if u in vertex and v in vertex:
+            arrays['uvs'] = np.stack([np.asarray(vertex[u]), np.asarray(vertex[v])], axis=1).astype(np.float32)
+            arrays['face_uvs_idx'] = arrays['faces']
+            break
+    if 'uvs' not in arrays and isinstance(face.get('texcoord'), np.ndarray) \
+            and face['texcoord'].shape[1] == 2 * indices.shape[1]:
+        # one uv per face corner
+        arrays['uvs'] = face['texcoord'].reshape(-1, 2).astype(np.float32)
+        arrays['face_uvs_idx'] = fan_triangulate(np.arange(arrays['uvs'].shape[0]), counts)
+    return arrays
@@ -0,0 +1,74 @@
+import torch
+
+
+def rasterize(height, width, face_vertices_z, face_vertices_image, face_features, tile_size=64, face_chunk_size=1024,
+              eps=1e-10):
+    # drop-in replacement for kal.render.mesh.rasterize that runs anywhere torch runs.
+    # face_vertices_z [B, F, 3], face_vertices_image [B, F, 3, 2], face_features [B, F, 3, C].
+    # Faces are tested against screen tiles by bounding box, the covered pixels of each tile get their closest face
+    # (largest z) through a z-buffer, features are then interpolated with screen space barycentrics.
+    # Returns features [B, H, W, C] (zero on the background) and face_idx [B, H, W] (-1 on the background)
+    n_views = face_vertices_image.shape[0]
+    device = face_vertices_image.device
+    dtype = face_vertices_image.dtype
+
+    # pixel centers in image space, y points up
+    xs = (2 * torch.arange(width, device=device, dtype=dtype) + 1) / width - 1
+    ys = 1 - (2 * torch.arange(height, device=device, dtype=dtype) + 1) / height
+
+    face_idx = torch.full((n_views, height, width), -1, dtype=torch.long, device=device)
+    with torch.no_grad():
+        for view in range(n_views):
+            vertices_image = face_vertices_image[view]
+            vertices_z = face_vertices_z[view]
+            x, y = vertices_image[..., 0], vertices_image[..., 1]
+            area = (x[:, 1] - x[:, 0]) * (y[:, 2] - y[:, 0]) - (x[:, 2] - x[:, 0]) * (y[:, 1] - y[:, 0])
+            valid = area.abs() > eps
+            min_x, max_x = x.min(dim=1)[0], x.max(dim=1)[0]
+            min_y, max_y = y.min(dim=1)[0], y.max(dim=1)[0]
+
+            for top in range(0, height, tile_size):
+                bottom = min(top + tile_size, height)
+                for left in range(0, width, tile_size):
+                    right = min(left + tile_size, width)
+                    candidates = (valid & (max_x >= xs[left]) & (min_x <= xs[right - 1]) &
+                                  (max_y >= ys[bottom - 1]) & (min_y <= ys[top])).nonzero()[:, 0]
+                    if candidates.shape[0] == 0:
+                        continue
+
+                    pixel_x = xs[left:right][None, :].expand(bottom - top, -1).reshape(-1, 1)
+                    pixel_y = ys[top:bottom][:, None].expand(-1, right - left).reshape(-1, 1)
+                    best_z = torch.full((pixel_x.shape[0],), -float('inf'), device=device, dtype=dtype)
+                    best_face = torch.full((pixel_x.shape[0],), -1, dtype=torch.long, device=device)
+                    for chunk in candidates.split(face_chunk_size):
+                        w0, w1, w2 = _barycentrics(pixel_x, pixel_y, x[chunk], y[chunk], area[chunk])
+                        pixel_z = w0 * vertices_z[chunk, 0] + w1 * vertices_z[chunk, 1] + w2 * vertices_z[chunk, 2]
+                        pixel_z[(w0 < 0) | (w1 < 0) | (w2 < 0)] = -float('inf')
+                        chunk_z, chunk_face = pixel_z.max(dim=1)
+                        closer = chunk_z > best_z
+                        best_z = torch.where(closer, chunk_z, best_z)
+                        best_face = torch.where(closer, chunk[chunk_face], best_face)
+                    face_idx[view, top:bottom, left:right] = best_face.view(bottom - top, right - left)
+
+        # barycentrics of the winning face of every pixel
+        pixel_x = xs[None, None, :].expand(n_views, height, -1)
+        pixel_y = ys[None, :, None].expand(n_views, -1, width)
+        view_idx = torch.arange(n_views, device=device)[:, None, None]
+        covered_idx = face_idx.clamp(min=0)
+        x = face_vertices_image[..., 0][view_idx, covered_idx]
+        y = face_vertices_image[..., 1][view_idx, covered_idx]
+        area = (x[..., 1] - x[..., 0]) * (y[..., 2] - y[..., 0]) - (x[..., 2] - x[..., 0]) * (y[..., 1] - y[..., 0])
+        area = torch.where(face_idx > -1, area, torch.ones_like(area))
+        barycentrics = torch.stack(_barycentrics(pixel_x, pixel_y, x, y, area), dim=-1)
+        barycentrics = barycentrics * (face_idx > -1)[..., None]
+
+    # interpolation is kept out of no_grad, gradients flow back to face_features
+    features = (barycentrics[..., None] * face_features[view_idx, covered_idx]).sum(dim=-2)
+    return features, face_idx
+
+
+def _barycentrics(pixel_x, pixel_y, x, y, area):
+    # screen space barycentrics of the pixels for triangles with corners x [..., 3], y [..., 3]
+    w0 = ((x[..., 1] - pixel_x) * (y[..., 2] - pixel_y) - (x[..., 2] - pixel_x) * (y[..., 1] - pixel_y)) / area
+    w1 = ((pixel_x - x[..., 0]) * (y[..., 2] - y[..., 0]) - (x[..., 2] - x[..., 0]) * (pixel_y - y[..., 0])) / area
+    return w0, w1, 1 - w0 - w1
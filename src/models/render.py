@@ -2,11 +2,22 @@ import kaolin as kal
 import torch
 import numpy as np
 from loguru import logger
+
+from src import utils
+from . import rasterizer
+from .gbuffer_cache import cat_render_caches, split_render_cache
+
+
 class Renderer:
     # from https://github.com/threedle/text2mesh
 
-    def __init__(self, device, dim=(224, 224), interpolation_mode='nearest'):
+    # G-buffers persisted by the disk cache
+    disk_gbuffers = ['face_idx', 'uv_features', 'depth_map']
+
+    def __init__(self, device, dim=(224, 224), interpolation_mode='nearest', cache_path=None, tile_size=None,
+                 cull_faces=False, backend='kaolin', face_chunk_size=None):
         assert interpolation_mode in ['nearest', 'bilinear', 'bicubic'], f'no interpolation mode {interpolation_mode}'
+        assert backend in ['kaolin', 'torch'], f'no rasterizer backend {backend}'
 
         camera = kal.render.camera.generate_perspective_projection(np.pi / 3).to(device)
 
@@ -15,53 +26,141 @@ class Renderer:
         self.camera_projection = camera
         self.dim = dim
         self.background = torch.ones(dim).to(device).float()
+        self.white = torch.ones(1, 1, 1, 1, device=device)
+        # rasterize and shade in tile_size x tile_size screen tiles, off when None
+        self.tile_size = tile_size
+        # drop back facing and off screen faces of the mesh before rasterizing,
+        # only valid for meshes with consistently oriented faces
+        self.cull_faces = cull_faces
+        # kaolin's CUDA rasterizer, or the pure torch one for CPU-only machines
+        self.rasterize_fn = kal.render.mesh.rasterize if backend == 'kaolin' else rasterizer.rasterize
+        # directory of the on-disk G-buffer cache, disabled when None
+        self.cache_path = None if cache_path is None else cache_path / 'gbuffers'
+        # large mesh mode: project and rasterize face_chunk_size faces at a time and merge the chunks by depth,
+        # render caches then hold normals images instead of per face normals. Off when None
+        self.face_chunk_size = face_chunk_size
+        if face_chunk_size is not None:
+            self.disk_gbuffers = Renderer.disk_gbuffers + ['normals_image']
+        # camera transforms of already seen poses, on device
+        self._cameras = {}
+        self.max_cached_cameras = 4096
 
     @staticmethod
     def get_camera_from_view(elev, azim, r=3.0, look_at_height=0.0):
-        x = r * torch.sin(elev) * torch.sin(azim)
-        y = r * torch.cos(elev)
-        z = r * torch.sin(elev) * torch.cos(azim)
+        return Renderer.cameras_from_poses(*[torch.as_tensor(x, dtype=torch.float32).reshape(1).cpu()
+                                             for x in (elev, azim, r, look_at_height)])
 
-        pos = torch.tensor([x, y, z]).unsqueeze(0)
+    @staticmethod
+    def cameras_from_poses(elevs, azims, radii, look_at_heights):
+        # [N, 4, 3] camera transforms from [N] tensors of poses, the cameras look at (0, look_at_height, 0)
+        x = radii * torch.sin(elevs) * torch.sin(azims)
+        y = radii * torch.cos(elevs)
+        z = radii * torch.sin(elevs) * torch.cos(azims)
+
+        pos = torch.stack([x, y, z], dim=-1)
         look_at = torch.zeros_like(pos)
-        look_at[:, 1] = look_at_height
-        direction = torch.tensor([0.0, 1.0, 0.0]).unsqueeze(0)
+        look_at[:, 1] = look_at_heights
+        direction = torch.tensor([0.0, 1.0, 0.0], device=pos.device).expand_as(pos)
 
-        camera_proj = kal.render.camera.generate_transformation_matrix(pos, look_at, direction)
-        return camera_proj
+        return kal.render.camera.generate_transformation_matrix(pos, look_at, direction)
 
 
     def normalize_depth(self, depth_map):
         assert depth_map.max() <= 0.0, 'depth map should be negative'
-        object_mask = depth_map != 0
-        # depth_map[object_mask] = (depth_map[object_mask] - depth_map[object_mask].min()) / (
-        #             depth_map[object_mask].max() - depth_map[object_mask].min())
-        # depth_map = depth_map ** 4
-        min_val = 0.5
-        depth_map[object_mask] = ((1 - min_val) * (depth_map[object_mask] - depth_map[object_mask].min()) / (
-                depth_map[object_mask].max() - depth_map[object_mask].min())) + min_val
+        # normalize each view of the batch separately
+        for view_depth_map in depth_map:
+            object_mask = view_depth_map != 0
+            # view_depth_map[object_mask] = (view_depth_map[object_mask] - view_depth_map[object_mask].min()) / (
+            #             view_depth_map[object_mask].max() - view_depth_map[object_mask].min())
+            # view_depth_map = view_depth_map ** 4
+            min_val = 0.5
+            view_depth_map[object_mask] = ((1 - min_val) * (view_depth_map[object_mask] - view_depth_map[object_mask].min()) / (
+                    view_depth_map[object_mask].max() - view_depth_map[object_mask].min())) + min_val
         # depth_map = (depth_map - depth_map.min()) / (depth_map.max() - depth_map.min())
         # depth_map[depth_map == 1] = 0 # Background gets largest value, set to 0
 
         return depth_map
 
-    def render_single_view(self, mesh, face_attributes, elev=0, azim=0, radius=2, look_at_height=0.0,calc_depth=True,dims=None, background_type='none'):
+    def tiles(self, height, width):
+        # (top, bottom, left, right) of the screen tiles, a single tile when tiling is off
+        tile_size = max(height, width) if self.tile_size is None else self.tile_size
+        for top in range(0, height, tile_size):
+            for left in range(0, width, tile_size):
+                yield top, min(top + tile_size, height), left, min(left + tile_size, width)
+
+    @staticmethod
+    def to_ndc_window(face_vertices_image, window):
+        # affine map of the image plane so that window = (x_min, y_min, x_max, y_max) covers [-1, 1]^2,
+        # window may also hold one such row per view
+        window = torch.as_tensor(window, dtype=face_vertices_image.dtype,
+                                 device=face_vertices_image.device).reshape(-1, 1, 1, 4)
+        center = (window[..., :2] + window[..., 2:]) / 2
+        half_size = (window[..., 2:] - window[..., :2]) / 2
+        return (face_vertices_image - center) / half_size
+
+    def object_windows(self, verts, camera_transforms, margin=1.1):
+        # square image windows [N, 4] around the projected object, framed like utils.get_nonzero_region.
+        # Only the vertices are projected, nothing is rasterized
+        vertices_camera = torch.nn.functional.pad(verts.to(self.device), (0, 1), value=1.) @ camera_transforms
+        vertices_image = kal.render.camera.perspective_camera(vertices_camera, self.camera_projection)
+        min_xy, max_xy = vertices_image.min(dim=1)[0], vertices_image.max(dim=1)[0]
+        center = (min_xy + max_xy) / 2
+        half_size = (max_xy - min_xy).max(dim=-1, keepdim=True)[0] / 2 * margin
+        return torch.cat([center - half_size, center + half_size], dim=-1)
+
+    def rasterize(self, dims, face_vertices_camera, face_vertices_image, face_features):
+        height, width = dims[1], dims[0]
+        if self.tile_size is None or (height <= self.tile_size and width <= self.tile_size):
+            return self.rasterize_fn(height, width, face_vertices_camera[:, :, :, -1],
+                                             face_vertices_image, face_features)
+
+        # rasterize tile by tile, so that the rasterizer memory follows the tile size and not the grid size.
+        # Each tile only gets the faces whose screen bounding box (in any view) overlaps it
+        n_views = face_features.shape[0]
+        features = face_features.new_zeros((n_views, height, width, face_features.shape[-1]))
+        face_idx = torch.full((n_views, height, width), -1, dtype=torch.long, device=face_features.device)
+        min_xy, max_xy = face_vertices_image.min(dim=2)[0], face_vertices_image.max(dim=2)[0]
+        for top, bottom, left, right in self.tiles(height, width):
+            # image y points up, so the first rows are at y = 1
+            window = (2 * left / width - 1, 1 - 2 * bottom / height, 2 * right / width - 1, 1 - 2 * top / height)
+            overlaps = ((max_xy[..., 0] >= window[0]) & (min_xy[..., 0] <= window[2]) &
+                        (max_xy[..., 1] >= window[1]) & (min_xy[..., 1] <= window[3])).any(dim=0)
+            tile_faces = overlaps.nonzero()[:, 0]
+            if tile_faces.shape[0] == 0:
+                continue
+            tile_features, tile_face_idx = self.rasterize_fn(
+                bottom - top, right - left, face_vertices_camera[:, tile_faces, :, -1],
+                self.to_ndc_window(face_vertices_image[:, tile_faces], window), face_features[:, tile_faces])
+            features[:, top:bottom, left:right] = tile_features
+            # back to indices of all the faces, as after culling
+            face_idx[:, top:bottom, left:right] = torch.where(tile_face_idx > -1, tile_faces[tile_face_idx],
+                                                              tile_face_idx)
+            del tile_features, tile_face_idx
+        return features, face_idx
+
+    def rasterize_with_depth(self, dims, face_vertices_camera, face_vertices_image, face_features):
+        # one rasterization pass for both the features and the camera depth, appended as an extra channel
+        face_features = torch.cat([face_features, face_vertices_camera[:, :, :, -1:]], dim=-1)
+        features, face_idx = self.rasterize(dims, face_vertices_camera, face_vertices_image, face_features)
+        return features[..., :-1], features[..., -1:], face_idx
+
+    def render_single_view(self, mesh, face_attributes, elev=0, azim=0, radius=2, look_at_height=0.0,calc_depth=True,dims=None, background_type='none',
+                           camera_transform=None):
         dims = self.dim if dims is None else dims
 
-        camera_transform = self.get_camera_from_view(torch.tensor(elev), torch.tensor(azim), r=radius,
-                                                look_at_height=look_at_height).to(self.device)
+        if camera_transform is None:
+            camera_transform = self.get_cameras_from_views(elev, azim, radius, look_at_height=look_at_height)
         face_vertices_camera, face_vertices_image, face_normals = kal.render.mesh.prepare_vertices(
             mesh.vertices.to(self.device), mesh.faces.to(self.device), self.camera_projection, camera_transform=camera_transform)
 
         if calc_depth:
-            depth_map, _ = kal.render.mesh.rasterize(dims[1], dims[0], face_vertices_camera[:, :, :, -1],
-                                                              face_vertices_image, face_vertices_camera[:, :, :, -1:])
+            image_features, depth_map, face_idx = self.rasterize_with_depth(dims, face_vertices_camera,
+                                                                            face_vertices_image, face_attributes)
             depth_map = self.normalize_depth(depth_map)
         else:
             depth_map = torch.zeros(1,64,64,1)
-
-        image_features, face_idx = kal.render.mesh.rasterize(dims[1], dims[0], face_vertices_camera[:, :, :, -1],
-                                                              face_vertices_image, face_attributes)
+            image_features, face_idx = self.rasterize(dims, face_vertices_camera, face_vertices_image,
+                                                      face_attributes)
 
         mask = (face_idx > -1).float()[..., None]
         if background_type == 'white':
@@ -72,64 +171,295 @@ class Renderer:
         return image_features.permute(0, 3, 1, 2), mask.permute(0, 3, 1, 2), depth_map.permute(0, 3, 1, 2)
 
 
-    def render_single_view_texture(self, verts, faces, uv_face_attr, texture_map, elev=0, azim=0, radius=2,
-                                   look_at_height=0.0, dims=None, background_type='none', render_cache=None):
+    def rasterize_background(self, mesh, camera_transform, dims=None, window=None):
+        # rasterize the barycentric coordinates of the background mesh once per camera,
+        # its face attributes can then be interpolated without rasterizing again
         dims = self.dim if dims is None else dims
+        n_views = camera_transform.shape[0]
+        face_vertices_camera, face_vertices_image, _ = kal.render.mesh.prepare_vertices(
+            mesh.vertices.to(self.device), mesh.faces.to(self.device), self.camera_projection,
+            camera_transform=camera_transform)
+        if window is not None:
+            face_vertices_image = self.to_ndc_window(face_vertices_image, window)
+        corners = torch.eye(3, device=self.device).repeat(n_views, face_vertices_image.shape[1], 1, 1)
+        barycentrics, face_idx = self.rasterize(dims, face_vertices_camera, face_vertices_image, corners)
+        return {'background_barycentrics': barycentrics, 'background_face_idx': face_idx}
 
-        if render_cache is None:
-
-            camera_transform = self.get_camera_from_view(torch.tensor(elev), torch.tensor(azim), r=radius,
-                                                    look_at_height=look_at_height).to(self.device)
-            face_vertices_camera, face_vertices_image, face_normals = kal.render.mesh.prepare_vertices(
-                verts.to(self.device), faces.to(self.device), self.camera_projection, camera_transform=camera_transform)
-
-            depth_map, _ = kal.render.mesh.rasterize(dims[1], dims[0], face_vertices_camera[:, :, :, -1],
-                                                              face_vertices_image, face_vertices_camera[:, :, :, -1:])
-            depth_map = self.normalize_depth(depth_map)
+    @staticmethod
+    def background_from_cache(render_cache, face_attributes):
+        # same as rasterizing face_attributes [1, F, 3, C] over the cached background mesh,
+        # barycentrics are zero outside of it
+        corner_attributes = face_attributes[0][render_cache['background_face_idx']]
+        image_features = (render_cache['background_barycentrics'][..., None] * corner_attributes).sum(dim=-2)
+        return image_features.permute(0, 3, 1, 2)
+
+    def get_cameras_from_views(self, elevs, azims, radii, look_at_height=0.0):
+        # [N, 4, 3] camera transforms on device, elevs / azims / radii / look_at_height are scalars, sequences or
+        # tensors broadcast against each other. Only poses not seen before are computed, in one batch
+        poses = torch.stack(torch.broadcast_tensors(*[torch.as_tensor(x, dtype=torch.float32).reshape(-1).cpu()
+                                                      for x in (elevs, azims, radii, look_at_height)]), dim=-1)
+        pose_keys = [tuple(pose) for pose in poses.tolist()]
+        missing = [i for i, pose_key in enumerate(pose_keys) if pose_key not in self._cameras]
+        if len(missing) > 0:
+            cameras = self.cameras_from_poses(*poses[missing].unbind(dim=-1)).to(self.device)
+            if len(self._cameras) + len(missing) > self.max_cached_cameras:
+                self._cameras = {}
+            for i, camera in zip(missing, cameras):
+                self._cameras[pose_keys[i]] = camera
+        return torch.stack([self._cameras[pose_key] for pose_key in pose_keys])
+
+    def rasterize_views(self, verts, faces, uv_face_attr, elevs, azims, radii, look_at_height=0.0, dims=None,
+                        batch_size=None, mesh_key=None, windows=None, camera_transforms=None):
+        # rasterize several views in one call, batch_size views at a time to keep memory bounded.
+        # With a mesh_key (content hash of verts, faces and uvs) views are read from / written to the disk cache.
+        # windows [N, 4] restricts each view to an image window (see object_windows), rendered at full dims.
+        # camera_transforms [N, 4, 3] replaces the views given by elevs, azims and radii
+        dims = self.dim if dims is None else dims
 
-            uv_features, face_idx = kal.render.mesh.rasterize(dims[1], dims[0], face_vertices_camera[:, :, :, -1],
-                face_vertices_image, uv_face_attr)
-            uv_features = uv_features.detach()
+        if camera_transforms is None:
+            camera_transforms = self.get_cameras_from_views(elevs, azims, radii, look_at_height=look_at_height)
+        batch_size = camera_transforms.shape[0] if batch_size is None else batch_size
+        verts, faces = verts.to(self.device), faces.to(self.device)
+        if windows is not None:
+            windows = torch.as_tensor(windows, dtype=torch.float32, device=self.device).reshape(-1, 4)
+
+        def batch_windows(views):
+            return None if windows is None else windows[views]
+
+        if mesh_key is None or self.cache_path is None:
+            return cat_render_caches([self.rasterize_batch(verts, faces, uv_face_attr,
+                                                           camera_transforms[start:start + batch_size], dims,
+                                                           window=batch_windows(slice(start, start + batch_size)))
+                                      for start in range(0, camera_transforms.shape[0], batch_size)])
+
+        view_keys = [utils.tensor_digest(mesh_key, camera_transforms[i], self.camera_projection, tuple(dims),
+                                         None if windows is None else windows[i])
+                     for i in range(camera_transforms.shape[0])]
+        render_caches = [self.load_gbuffers(view_key) for view_key in view_keys]
+        loaded = [i for i, render_cache in enumerate(render_caches) if render_cache is not None]
+        missing = [i for i, render_cache in enumerate(render_caches) if render_cache is None]
+
+        # the face normals are not stored, they only need the (cheap) vertex transform
+        for start in range(0, len(loaded), batch_size):
+            views = loaded[start:start + batch_size]
+            if self.face_chunk_size is None:
+                _, _, face_normals = kal.render.mesh.prepare_vertices(verts, faces, self.camera_projection,
+                                                                      camera_transform=camera_transforms[views])
+            for j, i in enumerate(views):
+                if self.face_chunk_size is None:
+                    render_caches[i]['face_normals'] = face_normals[j:j + 1]
+                else:
+                    render_caches[i]['z_normals_image'] = render_caches[i]['normals_image'][..., -1:]
+                render_caches[i]['camera_transform'] = camera_transforms[i:i + 1]
+                if windows is not None:
+                    render_caches[i]['window'] = windows[i:i + 1]
+
+        for start in range(0, len(missing), batch_size):
+            views = missing[start:start + batch_size]
+            render_cache = self.rasterize_batch(verts, faces, uv_face_attr, camera_transforms[views], dims,
+                                                window=batch_windows(views))
+            for i, view_render_cache in zip(views, split_render_cache(render_cache)):
+                self.save_gbuffers(view_keys[i], view_render_cache)
+                render_caches[i] = view_render_cache
+
+        return cat_render_caches(render_caches)
 
-        else:
-            # logger.info('Using render cache')
-            face_normals, uv_features, face_idx, depth_map = render_cache['face_normals'], render_cache['uv_features'], render_cache['face_idx'], render_cache['depth_map']
-        mask = (face_idx > -1).float()[..., None]
+    @staticmethod
+    def face_uvs(uv_face_attr, face_range=slice(None)):
+        # per face uvs [1, F, 3, 2] of face_range, uv_face_attr is either already per face
+        # or a (vt, ft) pair that is only indexed for the requested faces
+        if isinstance(uv_face_attr, tuple):
+            vt, ft = uv_face_attr
+            return vt[ft[face_range].long()].unsqueeze(0)
+        return uv_face_attr[:, face_range]
+
+    def rasterize_batch(self, verts, faces, uv_face_attr, camera_transform, dims, window=None):
+        if self.face_chunk_size is not None:
+            return self.rasterize_batch_chunked(verts, faces, uv_face_attr, camera_transform, dims, window=window)
+        n_views = camera_transform.shape[0]
+        face_vertices_camera, face_vertices_image, face_normals = kal.render.mesh.prepare_vertices(
+            verts, faces, self.camera_projection, camera_transform=camera_transform)
+        if window is not None:
+            face_vertices_image = self.to_ndc_window(face_vertices_image, window)
+
+        kept_faces = self.visible_faces(face_vertices_camera, face_vertices_image, face_normals) \
+            if self.cull_faces else None
+        if kept_faces is not None:
+            face_vertices_camera = face_vertices_camera[:, kept_faces]
+            face_vertices_image = face_vertices_image[:, kept_faces]
+        face_uvs = self.face_uvs(uv_face_attr, slice(None) if kept_faces is None else kept_faces)
+
+        uv_features, depth_map, face_idx = self.rasterize_with_depth(dims, face_vertices_camera,
+                                                                     face_vertices_image,
+                                                                     face_uvs.repeat(n_views, 1, 1, 1))
+        if kept_faces is not None:
+            # back to indices of the full mesh, face_normals are kept for all faces
+            face_idx = torch.where(face_idx > -1, kept_faces[face_idx], face_idx)
+        depth_map = self.normalize_depth(depth_map)
+        uv_features = uv_features.detach()
+        render_cache = {'uv_features': uv_features, 'face_normals': face_normals, 'face_idx': face_idx,
+                        'depth_map': depth_map, 'camera_transform': camera_transform}
+        if window is not None:
+            render_cache['window'] = window
+        return render_cache
+
+    def rasterize_batch_chunked(self, verts, faces, uv_face_attr, camera_transform, dims, window=None):
+        # same as rasterize_batch, but no per face buffer of the whole mesh is ever alive: each chunk of faces is
+        # projected and rasterized with its camera space normals as extra features, and a pixel keeps the chunk
+        # closest to the camera (largest z, as in the rasterizer)
+        n_views = camera_transform.shape[0]
+        uv_features, normals_image, depth_map, face_idx = None, None, None, None
+        for start in range(0, faces.shape[0], self.face_chunk_size):
+            face_range = slice(start, start + self.face_chunk_size)
+            face_vertices_camera, face_vertices_image, face_normals = kal.render.mesh.prepare_vertices(
+                verts, faces[face_range].long(), self.camera_projection, camera_transform=camera_transform)
+            if window is not None:
+                face_vertices_image = self.to_ndc_window(face_vertices_image, window)
+
+            kept_faces = self.visible_faces(face_vertices_camera, face_vertices_image, face_normals) \
+                if self.cull_faces else None
+            if kept_faces is not None:
+                face_vertices_camera = face_vertices_camera[:, kept_faces]
+                face_vertices_image = face_vertices_image[:, kept_faces]
+                face_normals = face_normals[:, kept_faces]
+            chunk_faces = torch.arange(start, min(start + self.face_chunk_size, faces.shape[0]),
+                                       device=faces.device)
+            if kept_faces is not None:
+                chunk_faces = chunk_faces[kept_faces]
+
+            face_features = torch.cat([self.face_uvs(uv_face_attr, chunk_faces).repeat(n_views, 1, 1, 1),
+                                       face_normals[:, :, None, :].expand(-1, -1, 3, -1)], dim=-1)
+            chunk_features, chunk_depth, chunk_face_idx = self.rasterize_with_depth(
+                dims, face_vertices_camera, face_vertices_image, face_features)
+            chunk_face_idx = torch.where(chunk_face_idx > -1, chunk_faces[chunk_face_idx], chunk_face_idx)
+            del face_vertices_camera, face_vertices_image, face_normals, face_features
+
+            if face_idx is None:
+                uv_features, normals_image = chunk_features[..., :2], chunk_features[..., 2:]
+                depth_map, face_idx = chunk_depth, chunk_face_idx
+                continue
+            closer = (chunk_face_idx > -1) & ((face_idx == -1) | (chunk_depth[..., 0] > depth_map[..., 0]))
+            uv_features = torch.where(closer[..., None], chunk_features[..., :2], uv_features)
+            normals_image = torch.where(closer[..., None], chunk_features[..., 2:], normals_image)
+            depth_map = torch.where(closer[..., None], chunk_depth, depth_map)
+            face_idx = torch.where(closer, chunk_face_idx, face_idx)
+
+        depth_map = self.normalize_depth(depth_map)
+        render_cache = {'uv_features': uv_features.detach(), 'normals_image': normals_image.detach(),
+                        'z_normals_image': normals_image[..., -1:].detach(), 'face_idx': face_idx,
+                        'depth_map': depth_map, 'camera_transform': camera_transform}
+        if window is not None:
+            render_cache['window'] = window
+        return render_cache
 
-        image_features = kal.render.mesh.texture_mapping(uv_features, texture_map, mode=self.interpolation_mode)
-        image_features = image_features * mask
+    @staticmethod
+    def visible_faces(face_vertices_camera, face_vertices_image, face_normals):
+        # indices of the faces that face at least one of the cameras and whose projected bounding box
+        # overlaps the screen, None when nothing would be culled away
+        # the camera sits at the origin of camera space, front faces have their normal pointing at it
+        front_facing = (face_normals * face_vertices_camera[:, :, 0]).sum(dim=-1) < 0
+        min_xy, max_xy = face_vertices_image.min(dim=2)[0], face_vertices_image.max(dim=2)[0]
+        on_screen = ((max_xy >= -1) & (min_xy <= 1)).all(dim=-1)
+        kept = (front_facing & on_screen).any(dim=0)
+        if kept.all() or not kept.any():
+            return None
+        return kept.nonzero()[:, 0]
+
+    def load_gbuffers(self, view_key):
+        arrays = utils.load_arrays(self.cache_path / view_key, self.disk_gbuffers)
+        if arrays is None:
+            return None
+        return {name: torch.from_numpy(array).to(self.device) for name, array in arrays.items()}
+
+    def save_gbuffers(self, view_key, render_cache):
+        utils.atomic_save_arrays(self.cache_path / view_key, {name: render_cache[name] for name in self.disk_gbuffers})
+
+    def texture_views(self, render_cache, texture_map, background_type='none', z_normals_only=False):
+        # texture lookup on top of a (possibly batched) render cache, no rasterization involved.
+        # The mask and normals image only depend on the geometry, they are computed once and kept in the render cache
+        uv_features, face_idx, depth_map = render_cache['uv_features'], render_cache['face_idx'], \
+                                           render_cache['depth_map']
+        n_views, height, width = face_idx.shape
+        if 'mask' not in render_cache:
+            render_cache['mask'] = (face_idx > -1).float()[..., None]
+        mask = render_cache['mask']
+        normals_key = 'z_normals_image' if z_normals_only else 'normals_image'
+        if normals_key not in render_cache:
+            face_normals = render_cache['face_normals'][..., -1:] if z_normals_only else render_cache['face_normals']
+            view_idx = torch.arange(n_views, device=face_idx.device)[:, None, None]
+            render_cache[normals_key] = face_normals[view_idx, face_idx, :]
+        normals_image = render_cache[normals_key]
+        texture_map = texture_map.expand(n_views, -1, -1, -1)
+
+        background = None
         if background_type == 'white':
-            image_features += 1 * (1 - mask)
+            background = self.white
         elif background_type == 'random':
-            image_features += torch.rand((1,1,1,3)).to(self.device) * (1 - mask)
+            background = torch.rand((n_views, 1, 1, 3)).to(self.device)
+
+        def shade(top, bottom, left, right):
+            tile_mask = mask[:, top:bottom, left:right]
+            tile_features = kal.render.mesh.texture_mapping(uv_features[:, top:bottom, left:right], texture_map,
+                                                            mode=self.interpolation_mode)
+            if background is None:
+                return tile_features * tile_mask
+            return torch.lerp(background, tile_features, tile_mask)
+
+        if self.tile_size is None:
+            image_features = shade(0, height, 0, width)
+        else:
+            # shade tile by tile to bound the temporary buffers
+            image_features = uv_features.new_zeros((n_views, height, width, texture_map.shape[1]))
+            for top, bottom, left, right in self.tiles(height, width):
+                image_features[:, top:bottom, left:right] = shade(top, bottom, left, right)
 
-        normals_image = face_normals[0][face_idx, :]
+        return image_features.permute(0, 3, 1, 2), mask.permute(0, 3, 1, 2), \
+               depth_map.permute(0, 3, 1, 2), normals_image.permute(0, 3, 1, 2), render_cache
 
-        render_cache = {'uv_features':uv_features, 'face_normals':face_normals,'face_idx':face_idx, 'depth_map':depth_map}
+    def render_single_view_texture(self, verts, faces, uv_face_attr, texture_map, elev=0, azim=0, radius=2,
+                                   look_at_height=0.0, dims=None, background_type='none', render_cache=None,
+                                   mesh_key=None, window=None, z_normals_only=False, camera_transform=None):
+        if render_cache is None:
+            render_cache = self.rasterize_views(verts, faces, uv_face_attr, [elev], [azim], [radius],
+                                                look_at_height=look_at_height, dims=dims, mesh_key=mesh_key,
+                                                windows=None if window is None else torch.as_tensor(window).reshape(1, 4),
+                                                camera_transforms=camera_transform)
+
+        return self.texture_views(render_cache, texture_map, background_type=background_type,
+                                  z_normals_only=z_normals_only)
+
+    def render_multi_view_texture(self, verts, faces, uv_face_attr, texture_map, elevs, azims, radii,
+                                  look_at_height=0.0, dims=None, background_type='none', render_cache=None,
+                                  batch_size=None, mesh_key=None, z_normals_only=False, camera_transforms=None):
+        # same outputs as render_single_view_texture, stacked over the N given views
+        if render_cache is None:
+            render_cache = self.rasterize_views(verts, faces, uv_face_attr, elevs, azims, radii,
+                                                look_at_height=look_at_height, dims=dims, batch_size=batch_size,
+                                                mesh_key=mesh_key, camera_transforms=camera_transforms)
 
-        return image_features.permute(0, 3, 1, 2), mask.permute(0, 3, 1, 2),\
-               depth_map.permute(0, 3, 1, 2), normals_image.permute(0, 3, 1, 2), render_cache
+        return self.texture_views(render_cache, texture_map, background_type=background_type,
+                                  z_normals_only=z_normals_only)
 
     def project_uv_single_view(self, verts, faces, uv_face_attr, elev=0, azim=0, radius=2,
-                               look_at_height=0.0, dims=None, background_type='none'):
+                               look_at_height=0.0, dims=None, background_type='none', camera_transform=None):
         # project the vertices and interpolate the uv coordinates
 
         dims = self.dim if dims is None else dims
 
-        camera_transform = self.get_camera_from_view(torch.tensor(elev), torch.tensor(azim), r=radius,
-                                                     look_at_height=look_at_height).to(self.device)
+        if camera_transform is None:
+            camera_transform = self.get_cameras_from_views(elev, azim, radius, look_at_height=look_at_height)
         face_vertices_camera, face_vertices_image, face_normals = kal.render.mesh.prepare_vertices(
             verts.to(self.device), faces.to(self.device), self.camera_projection, camera_transform=camera_transform)
 
-        uv_features, face_idx = kal.render.mesh.rasterize(dims[1], dims[0], face_vertices_camera[:, :, :, -1],
-                                                          face_vertices_image, uv_face_attr)
+        uv_features, face_idx = self.rasterize(dims, face_vertices_camera, face_vertices_image,
+                                               self.face_uvs(uv_face_attr))
         return face_vertices_image, face_vertices_camera, uv_features, face_idx
 
     def project_single_view(self, verts, faces, elev=0, azim=0, radius=2,
-                               look_at_height=0.0):
+                               look_at_height=0.0, camera_transform=None):
         # only project the vertices
-        camera_transform = self.get_camera_from_view(torch.tensor(elev), torch.tensor(azim), r=radius,
-                                                     look_at_height=look_at_height).to(self.device)
+        if camera_transform is None:
+            camera_transform = self.get_cameras_from_views(elev, azim, radius, look_at_height=look_at_height)
         face_vertices_camera, face_vertices_image, face_normals = kal.render.mesh.prepare_vertices(
             verts.to(self.device), faces.to(self.device), self.camera_projection, camera_transform=camera_transform)
 
@@ -1,3 +1,4 @@
+import contextlib
 import os
 
 import kaolin as kal
@@ -11,8 +12,13 @@ import torch.nn.functional as F
 from loguru import logger
 from PIL import Image
 
+from src import utils
+from .gbuffer_cache import GBufferCache, cat_render_caches, split_render_cache
+from . import mesh_io
 from .mesh import Mesh
 from .render import Renderer
+from .unwrap import parallel_unwrap, xatlas_unwrap
+from .visibility import TexelVisibility
 from src.configs.train_config import GuideConfig
 
 
@@ -42,36 +48,29 @@ def build_cotan_laplacian_torch(points_tensor: torch.Tensor, tris_tensor: torch.
 
 
 def build_graph_laplacian_torch(tris_tensor: torch.Tensor) -> np.ndarray:
-    tris = tris_tensor.cpu().numpy()
+    tris = tris_tensor.cpu().numpy().astype(np.int64)
     n_verts = tris.max() + 1
-    v2v = [[] for _ in range(n_verts)]
-    for face in tris:
-        for i in face:
-            for j in face:
-                if i != j:
-                    if j not in v2v[i]:
-                        v2v[i].append(j)
-
-    valency = [len(x) for x in v2v]
-    I, J, vals = [], [], []
-    for i in range(n_verts):
-        I.append(i)
-        J.append(i)
-        vals.append(1)
-
-        for neighbor in v2v[i]:
-            I.append(i)
-            J.append(neighbor)
-            vals.append(-1 / valency[i])
-    L = sparse.csr_matrix((vals, (I, J)), shape=(n_verts, n_verts))
+    # directed edges between the corners of every face, deduplicated through their i * n_verts + j keys
+    I = np.concatenate([tris[:, 0], tris[:, 0], tris[:, 1], tris[:, 1], tris[:, 2], tris[:, 2]])
+    J = np.concatenate([tris[:, 1], tris[:, 2], tris[:, 0], tris[:, 2], tris[:, 0], tris[:, 1]])
+    not_loop = I != J
+    edge_keys = np.unique(I[not_loop] * n_verts + J[not_loop])
+    I, J = edge_keys // n_verts, edge_keys % n_verts
+
+    valency = np.bincount(I, minlength=n_verts)
+    diagonal = np.arange(n_verts)
+    rows = np.concatenate([diagonal, I])
+    cols = np.concatenate([diagonal, J])
+    vals = np.concatenate([np.ones(n_verts), -1 / valency[I]])
+    L = sparse.csr_matrix((vals, (rows, cols)), shape=(n_verts, n_verts))
     return L
 
 
-def eigen_problem(Lap, k=20, e=0.0) -> (torch.Tensor, torch.Tensor):
+def eigen_problem(Lap, k=20, e=0.0, tol=1e-3) -> (torch.Tensor, torch.Tensor):
     shift = 1e-4
     eigenvalues, eigenvectors = eigsh(
         Lap + shift * scipy.sparse.eye(Lap.shape[0]),
-        k=k + 1, which='LM', sigma=e, tol=1e-3)
+        k=k + 1, which='LM', sigma=e, tol=tol)
     eigenvalues += shift
 
     eigenvalues = eigenvalues[1:]
@@ -80,6 +79,62 @@ def eigen_problem(Lap, k=20, e=0.0) -> (torch.Tensor, torch.Tensor):
     return torch.from_numpy(eigenvalues).float(), torch.from_numpy(eigenvectors.T).float()
 
 
+def eigen_problem_lobpcg(Lap, k=20, tol=1e-3, n_iter=1000):
+    # approximate smallest eigenpairs (sigma=0 in eigen_problem) by block LOBPCG with a Jacobi preconditioner,
+    # only sparse products with Lap, multithreaded by torch. None when the eigenpairs did not converge
+    # to residuals |Lap x - lambda x| below tol (relative to the largest eigenvalue when above 1)
+    shift = 1e-4
+    Lap = (Lap + shift * scipy.sparse.eye(Lap.shape[0])).tocoo()
+    n_verts = Lap.shape[0]
+    A = torch.sparse_coo_tensor(np.vstack([Lap.row, Lap.col]), Lap.data, (n_verts, n_verts),
+                                dtype=torch.float64).coalesce()
+    diagonal = np.arange(n_verts)
+    # the cotan diagonal can be zero or negative around obtuse triangles, the preconditioner has to stay positive
+    iK = torch.sparse_coo_tensor(np.vstack([diagonal, diagonal]), 1 / np.maximum(Lap.diagonal(), shift),
+                                 (n_verts, n_verts), dtype=torch.float64).coalesce()
+    X = torch.randn(n_verts, k + 1, dtype=torch.float64, generator=torch.Generator().manual_seed(0))
+    eigenvalues, eigenvectors = torch.lobpcg(A, X=X, iK=iK, niter=n_iter, tol=tol, largest=False)
+    # lobpcg stops after n_iter without telling whether it converged
+    residuals = (torch.sparse.mm(A, eigenvectors) - eigenvectors * eigenvalues).norm(dim=0)
+    if not torch.isfinite(residuals).all() or residuals.max() > tol * max(1.0, eigenvalues.abs().max().item()):
+        logger.warning(f'lobpcg did not converge after {n_iter} iterations, max residual {residuals.max():.3g}')
+        return None
+    order = eigenvalues.argsort()
+    eigenvalues, eigenvectors = eigenvalues[order] + shift, eigenvectors[:, order]
+
+    eigenvalues = eigenvalues[1:]
+    eigenvectors = eigenvectors[:, 1:]
+
+    return eigenvalues.float(), eigenvectors.T.float().contiguous()
+
+
+def texel_taps(uv: torch.Tensor, height: int, width: int, mode: str = 'bilinear'):
+    # texels read by kaolin's texture_mapping (grid_sample, align_corners=False, v flipped) at uv [N, 2].
+    # Returns flat texel indices [N, K] and their weights [N, K] (K = 1 nearest, 4 bilinear), taps outside the texture
+    # get weight 0. For bicubic the 16 taps are returned without weights
+    x = uv[:, 0] * width - 0.5
+    y = (1 - uv[:, 1]) * height - 0.5
+    if mode == 'nearest':
+        # grid_sample rounds half to even, like torch.round
+        x, y = torch.round(x).long(), torch.round(y).long()
+        inside = (x >= 0) & (x < width) & (y >= 0) & (y < height)
+        return (y.clamp(0, height - 1) * width + x.clamp(0, width - 1))[:, None], inside.float()[:, None]
+
+    x0, y0 = torch.floor(x), torch.floor(y)
+    if mode == 'bicubic':
+        offsets = torch.arange(-1, 3, device=uv.device)
+        xs = (x0.long()[:, None] + offsets).clamp(0, width - 1)
+        ys = (y0.long()[:, None] + offsets).clamp(0, height - 1)
+        return (ys[:, :, None] * width + xs[:, None, :]).reshape(-1, 16), None
+
+    fx, fy = x - x0, y - y0
+    xs = torch.stack([x0, x0 + 1, x0, x0 + 1], dim=1).long()
+    ys = torch.stack([y0, y0, y0 + 1, y0 + 1], dim=1).long()
+    weights = torch.stack([(1 - fx) * (1 - fy), fx * (1 - fy), (1 - fx) * fy, fx * fy], dim=1)
+    inside = (xs >= 0) & (xs < width) & (ys >= 0) & (ys < height)
+    return ys.clamp(0, height - 1) * width + xs.clamp(0, width - 1), weights * inside
+
+
 def choose_multi_modal(n: int, k: int):
     interval_length = n // k
     n_intervals = n / interval_length
@@ -103,7 +158,16 @@ class TexturedMeshModel(nn.Module):
                  cache_path=None,
                  device=torch.device('cpu'),
                  augmentations=False,
-                 augment_prob=0.5):
+                 augment_prob=0.5,
+                 view_batch_size=8,
+                 gbuffer_cache_bytes=0,
+                 gbuffer_cache_half=False,
+                 disk_gbuffer_cache=False,
+                 render_tile_size=None,
+                 cull_faces=False,
+                 lod_grid_sizes=(256, 128, 64),
+                 rasterizer='kaolin',
+                 face_chunk_size=None):
 
         super().__init__()
         self.device = device
@@ -119,27 +183,61 @@ class TexturedMeshModel(nn.Module):
             self.initial_texture_path = self.opt.initial_texture
         self.cache_path = cache_path
         self.num_features = 3
+        self.view_batch_size = view_batch_size
+        # G-buffers of already rendered views, self.mesh is normalized once in init_meshes and its vertices do not
+        # change afterwards (augmentations deform copies and bypass the cache)
+        self.gbuffer_cache = GBufferCache(max_bytes=gbuffer_cache_bytes, half_precision=gbuffer_cache_half)
+        # large mesh mode, see Renderer.face_chunk_size
+        self.large_mesh = face_chunk_size is not None
 
         self.renderer = Renderer(device=self.device, dim=(render_grid_size, render_grid_size),
-                                 interpolation_mode=self.opt.texture_interpolation_mode)
+                                 interpolation_mode=self.opt.texture_interpolation_mode,
+                                 cache_path=cache_path if disk_gbuffer_cache else None,
+                                 tile_size=render_tile_size,
+                                 cull_faces=cull_faces,
+                                 backend=rasterizer,
+                                 face_chunk_size=face_chunk_size)
         self.env_sphere, self.mesh = self.init_meshes()
         self.default_color = [0.8, 0.1, 0.8]
+        self.register_buffer('default_color_tensor',
+                             torch.tensor(self.default_color, device=self.device).view(1, 3, 1, 1), persistent=False)
         self.background_sphere_colors, self.texture_img = self.init_paint()
         self.meta_texture_img = nn.Parameter(torch.zeros_like(self.texture_img))
         if self.opt.reference_texture:
             base_texture = torch.Tensor(np.array(Image.open(self.opt.reference_texture).resize(
-                (self.texture_resolution, self.texture_resolution)))).permute(2, 0, 1).cuda().unsqueeze(0) / 255.0
+                (self.texture_resolution, self.texture_resolution)))).permute(2, 0, 1).to(self.device).unsqueeze(0) / 255.0
             change_mask = (
                     (base_texture.to(self.device) - self.texture_img).abs().sum(axis=1) > 0.1).float()
             with torch.no_grad():
                 self.meta_texture_img[:, 1] = change_mask
         self.vt, self.ft = self.init_texture_map()
 
-        self.face_attributes = kal.ops.mesh.index_vertices_by_faces(
-            self.vt.unsqueeze(0),
-            self.ft.long()).detach()
+        if self.large_mesh:
+            # per face uvs are gathered chunk by chunk by the renderer, see Renderer.face_uvs
+            self.face_attributes = (self.vt, self.ft)
+        else:
+            self.face_attributes = kal.ops.mesh.index_vertices_by_faces(
+                self.vt.unsqueeze(0),
+                self.ft.long()).detach()
+        # content hash of the rendered geometry, keys the on-disk G-buffer cache
+        self.mesh_key = utils.tensor_digest(self.mesh.vertices, self.mesh.faces, self.vt, self.ft) \
+            if disk_gbuffer_cache else None
+
+        # decimated versions of the mesh, level i > 0 clusters vertices on a lod_grid_sizes[i - 1]^3 grid
+        self.lod_grid_sizes = list(lod_grid_sizes)
+        self._lods = {}
+        # ray cast texel visibility, built on first use
+        self._texel_visibility = None
+
+        # painted texel statistics (see texture_stats) and the median filled texture, both follow texture_img
+        self._texture_stats = None
+        self._texture_stats_version = None
+        self._median_texture = None
+        self._median_texture_version = None
 
         self.n_eigen_values = 20
+        # [K, V, 3] augmented vertex sets, built on first use
+        self._augmentation_bank = None
         self._L = None
         self._eigenvalues = None
         self._eigenvectors = None
@@ -152,12 +250,49 @@ class TexturedMeshModel(nn.Module):
 
     def eigens(self, k: int, e: float) -> (torch.Tensor, torch.Tensor):
         if self._eigenvalues is None or self._eigenvectors is None:
-            self._eigenvalues, self._eigenvectors = eigen_problem(self.L, k, e)
+            solver = self.eigen_solver(e)
+            eigen_path = self.eigen_cache_path(k, e, solver)
+            arrays = None if eigen_path is None else utils.load_arrays(eigen_path, ['eigenvalues', 'eigenvectors'])
+            if arrays is not None:
+                self._eigenvalues = torch.from_numpy(arrays['eigenvalues'])
+                self._eigenvectors = torch.from_numpy(arrays['eigenvectors'])
+            else:
+                eigenpairs = None
+                if solver == 'lobpcg':
+                    logger.info(f'solving for {k} eigenvectors of {self.mesh.vertices.shape[0]} vertices with lobpcg')
+                    eigenpairs = eigen_problem_lobpcg(self.L, k, tol=self.opt.eigen_tol)
+                    if eigenpairs is None:
+                        logger.warning('falling back to the shift_invert eigensolver')
+                        eigen_path = self.eigen_cache_path(k, e, 'shift_invert')
+                if eigenpairs is None:
+                    eigenpairs = eigen_problem(self.L, k, e, tol=self.opt.eigen_tol)
+                self._eigenvalues, self._eigenvectors = eigenpairs
+                if eigen_path is not None:
+                    utils.atomic_save_arrays(eigen_path, {'eigenvalues': self._eigenvalues,
+                                                          'eigenvectors': self._eigenvectors})
             self._eigenvalues, self._eigenvectors = \
                 self._eigenvalues.to(self.device), self._eigenvectors.to(self.device)
 
         return self._eigenvalues, self._eigenvectors
 
+    def eigen_solver(self, e: float) -> str:
+        solver = self.opt.eigen_solver
+        assert solver in ['auto', 'shift_invert', 'lobpcg'], f'no eigensolver {solver}'
+        if solver == 'auto':
+            solver = 'lobpcg' if self.mesh.vertices.shape[0] > self.opt.eigen_lobpcg_threshold else 'shift_invert'
+        if solver == 'lobpcg' and e != 0:
+            # lobpcg only finds the smallest eigenvalues
+            logger.warning(f'lobpcg cannot solve around sigma={e}, using shift_invert')
+            solver = 'shift_invert'
+        return solver
+
+    def eigen_cache_path(self, k: int, e: float, solver: str):
+        # eigenvalues / eigenvectors directory of the cache dir, keyed on the mesh content and the eigen problem
+        if self.cache_path is None:
+            return None
+        eigen_key = utils.tensor_digest(self.mesh.vertices, self.mesh.faces, k, e, solver, self.opt.eigen_tol)
+        return self.cache_path / f'eigens_{eigen_key}'
+
     @staticmethod
     def normalize_vertices(vertices: torch.Tensor, mesh_scale: float = 1.0, dy: float = 0.0) -> torch.Tensor:
         vertices -= vertices.mean(dim=0)[None, :]
@@ -166,9 +301,19 @@ class TexturedMeshModel(nn.Module):
         vertices[:, 1] += dy
         return vertices
 
+    @staticmethod
+    def normalize_vertex_sets(vertices: torch.Tensor, mesh_scale: float = 1.0, dy: float = 0.0) -> torch.Tensor:
+        # normalize_vertices over a batch [K, V, 3], not in place
+        vertices = vertices - vertices.mean(dim=1, keepdim=True)
+        vertices = vertices / vertices.norm(dim=-1).amax(dim=1)[:, None, None] * mesh_scale
+        return vertices + torch.tensor([0.0, dy, 0.0], device=vertices.device)
+
+    def normalized_basis_functions(self) -> torch.Tensor:
+        _, basis_functions = self.eigens(self.n_eigen_values, 0.0)
+        return basis_functions / (basis_functions.max(dim=-1)[0][:, None] - basis_functions.min(dim=-1)[0][:, None])
+
     def spectral_augmentations(self, vertices: torch.Tensor) -> torch.Tensor:
-        eigen_values, basis_functions = self.eigens(self.n_eigen_values, 0.0)
-        basis_functions /= basis_functions.max(dim=-1)[0][:, None] - basis_functions.min(dim=-1)[0][:, None]
+        basis_functions = self.normalized_basis_functions()
 
         chosen_basis_function = choose_multi_modal(basis_functions.shape[0], 2)
         coeffs = torch.zeros(basis_functions.shape[0]).to(self.device)
@@ -192,7 +337,43 @@ class TexturedMeshModel(nn.Module):
         deformed_v[:, squish_axis] *= squish_factor
         return self.normalize_vertices(deformed_v, mesh_scale=self.mesh_scale, dy=self.dy)
 
+    def build_augmentation_bank(self, bank_size: int, stretch_factor: float = 1.6,
+                                squish_factor: float = 0.7) -> torch.Tensor:
+        # bank_size draws of augment_vertices, computed together
+        vertices = self.mesh.vertices
+        basis_functions = self.normalized_basis_functions().float()
+        n_basis = basis_functions.shape[0]
+
+        # spectral augmentations, the coefficients of the skipped draws stay zero
+        coeffs = torch.zeros(bank_size, n_basis, device=self.device)
+        for i in np.nonzero(np.random.rand(bank_size) < 0.5)[0]:
+            chosen_basis_function = choose_multi_modal(n_basis, 2)
+            signs = ((torch.rand(len(chosen_basis_function), device=self.device) > 0.5).float() - 0.5) * 2
+            coeffs[i, chosen_basis_function] = signs
+        reconstructed = coeffs @ basis_functions
+        directions = vertices / torch.norm(vertices, dim=1)[:, None]
+        deformed_v = vertices[None] + 0.25 * reconstructed[:, :, None] * directions[None]
+        # normalizing is a no-op on undeformed draws, the mesh is already normalized
+        deformed_v = self.normalize_vertex_sets(deformed_v, mesh_scale=self.mesh_scale, dy=self.dy)
+
+        # axis augmentations, one stretched and one squished axis per draw
+        axis_scales = torch.ones(bank_size, 3, device=self.device)
+        use_axis = torch.from_numpy(np.random.rand(bank_size) < 0.5).to(self.device)
+        axis_indices = torch.from_numpy(np.argsort(np.random.rand(bank_size, 3), axis=1)).to(self.device)
+        draws = torch.arange(bank_size, device=self.device)
+        axis_scales[draws, axis_indices[:, 0]] = 1 + use_axis.float() * (stretch_factor - 1)
+        axis_scales[draws, axis_indices[:, 1]] = 1 + use_axis.float() * (squish_factor - 1)
+        deformed_v = deformed_v * axis_scales[:, None, :]
+        return self.normalize_vertex_sets(deformed_v, mesh_scale=self.mesh_scale, dy=self.dy)
+
     def augment_vertices(self):
+        bank_size = self.opt.augmentation_bank_size
+        if bank_size > 0:
+            if self._augmentation_bank is None:
+                logger.info(f'building a bank of {bank_size} augmented meshes')
+                self._augmentation_bank = self.build_augmentation_bank(bank_size)
+            return self._augmentation_bank[np.random.randint(bank_size)]
+
         verts = self.mesh.vertices.clone()
         if np.random.rand() < 0.5:
             verts = self.spectral_augmentations(verts)
@@ -203,11 +384,30 @@ class TexturedMeshModel(nn.Module):
     def init_meshes(self, env_sphere_path='shapes/env_sphere.obj'):
         env_sphere = Mesh(env_sphere_path, self.device)
 
-        mesh = Mesh(self.opt.shape_path, self.device)
+        mesh = Mesh(self.opt.shape_path, self.device, index_dtype=torch.int32 if self.large_mesh else torch.long)
         mesh.normalize_mesh(inplace=True, target_scale=self.mesh_scale, dy=self.dy)
 
         return env_sphere, mesh
 
+    def lod_geometry(self, lod: int = 0):
+        # vertices, faces, uv face attributes and disk cache key of a level of detail, 0 is the full mesh
+        if not 0 <= lod <= len(self.lod_grid_sizes):
+            raise ValueError(f'lod {lod} out of range, expected 0 to {len(self.lod_grid_sizes)} '
+                             f'(lod_grid_sizes {tuple(self.lod_grid_sizes)})')
+        if lod == 0:
+            return self.mesh.vertices, self.mesh.faces, self.face_attributes, self.mesh_key
+        if lod not in self._lods:
+            grid_size = self.lod_grid_sizes[lod - 1]
+            lod_mesh, face_indices = self.mesh.decimate(grid_size)
+            logger.info(f'built mesh lod {lod}: {lod_mesh.faces.shape[0]} faces out of {self.mesh.faces.shape[0]}')
+            mesh_key = None if self.mesh_key is None else utils.tensor_digest(self.mesh_key, grid_size)
+            if self.large_mesh:
+                face_attributes = (self.vt, self.ft[face_indices.to(self.ft.device)])
+            else:
+                face_attributes = self.face_attributes[:, face_indices.to(self.face_attributes.device)]
+            self._lods[lod] = (lod_mesh.vertices, lod_mesh.faces, face_attributes, mesh_key)
+        return self._lods[lod]
+
     def zero_meta(self):
         with torch.no_grad():
             self.meta_texture_img[:] = 0
@@ -217,15 +417,15 @@ class TexturedMeshModel(nn.Module):
         init_background_bases = torch.rand(num_backgrounds, 3).to(self.device)
         modulated_init_background_bases_latent = init_background_bases[:, None, None, :] * 0.8 + 0.2 * torch.randn(
             num_backgrounds, self.env_sphere.faces.shape[0],
-            3, self.num_features, dtype=torch.float32).cuda()
-        background_sphere_colors = nn.Parameter(modulated_init_background_bases_latent.cuda())
+            3, self.num_features, dtype=torch.float32).to(self.device)
+        background_sphere_colors = nn.Parameter(modulated_init_background_bases_latent.to(self.device))
 
         if self.initial_texture_path is not None:
             texture = torch.Tensor(np.array(Image.open(self.initial_texture_path).resize(
-                (self.texture_resolution, self.texture_resolution)))).permute(2, 0, 1).cuda().unsqueeze(0) / 255.0
+                (self.texture_resolution, self.texture_resolution)))).permute(2, 0, 1).to(self.device).unsqueeze(0) / 255.0
         else:
-            texture = torch.ones(1, 3, self.texture_resolution, self.texture_resolution).cuda() * torch.Tensor(
-                self.default_color).reshape(1, 3, 1, 1).cuda()
+            texture = torch.ones(1, 3, self.texture_resolution, self.texture_resolution).to(self.device) * torch.Tensor(
+                self.default_color).reshape(1, 3, 1, 1).to(self.device)
         texture_img = nn.Parameter(texture)
         return background_sphere_colors, texture_img
 
@@ -234,7 +434,7 @@ class TexturedMeshModel(nn.Module):
         A = self.linear_rgb_estimator.T
         regularizer = 1e-2
 
-        pinv = (torch.pinverse(A.T @ A + regularizer * torch.eye(4).cuda()) @ A.T)
+        pinv = (torch.pinverse(A.T @ A + regularizer * torch.eye(4).to(self.device)) @ A.T)
         if len(color) == 1 or type(color) is torch.Tensor:
             init_color_in_latent = color @ pinv.T
         else:
@@ -243,48 +443,106 @@ class TexturedMeshModel(nn.Module):
         return init_color_in_latent
 
     def change_default_to_median(self):
-        diff = (self.texture_img - torch.tensor(self.default_color).view(1, 3, 1, 1).to(
-            self.device)).abs().sum(axis=1)
-        default_mask = (diff < 0.1).float().unsqueeze(0)
-        median_color = self.texture_img[0, :].reshape(3, -1)[:, default_mask.flatten() == 0].mean(axis=1)
+        painted, color_sum, n_painted = self.texture_stats()
         with torch.no_grad():
-            self.texture_img.reshape(3, -1)[:, default_mask.flatten() == 1] = median_color.reshape(-1, 1)
+            self.texture_img.reshape(3, -1)[:, ~painted] = (color_sum / n_painted).reshape(-1, 1)
+
+    @torch.no_grad()
+    def painted_texels(self, texel_idx=None):
+        # texels that differ from the default color, of the whole texture or of the flat texel indices texel_idx
+        colors = self.texture_img.reshape(3, -1)
+        if texel_idx is not None:
+            colors = colors[:, texel_idx]
+        return (colors - self.default_color_tensor.reshape(3, 1)).abs().sum(dim=0) >= 0.1
+
+    def texture_stats(self):
+        # painted texel mask [H * W], sum of the painted colors [3] and number of painted texels.
+        # Kept up to date by texture_update, any other change of texture_img triggers a full rescan
+        if self._texture_stats is None or self._texture_stats_version != self.texture_img._version:
+            with torch.no_grad():
+                painted = self.painted_texels()
+                self._texture_stats = [painted, self.texture_img.reshape(3, -1)[:, painted].sum(dim=1),
+                                       painted.sum()]
+            self._texture_stats_version = self.texture_img._version
+        return self._texture_stats
+
+    @contextlib.contextmanager
+    def texture_update(self, texel_idx: torch.Tensor):
+        # block that only changes the texels texel_idx (flat indices) of texture_img,
+        # the painted texel statistics are then updated for these texels only
+        texture_stats = self.texture_stats()
+        painted, color_sum, n_painted = texture_stats
+        texel_idx = torch.unique(texel_idx)
+        with torch.no_grad():
+            was_painted = texel_idx[painted[texel_idx]]
+            color_sum -= self.texture_img.reshape(3, -1)[:, was_painted].sum(dim=1)
+            n_painted -= was_painted.shape[0]
+        try:
+            yield
+        except BaseException:
+            # the statistics were left partially decremented, rescan on next use
+            self._texture_stats = None
+            raise
+        if self._texture_stats is not texture_stats:
+            # rescanned inside the block, the partial statistics are stale
+            self._texture_stats = None
+            return
+        with torch.no_grad():
+            painted[texel_idx] = self.painted_texels(texel_idx)
+            now_painted = texel_idx[painted[texel_idx]]
+            color_sum += self.texture_img.reshape(3, -1)[:, now_painted].sum(dim=1)
+            n_painted += now_painted.shape[0]
+        self._texture_stats = [painted, color_sum, n_painted]
+        self._texture_stats_version = self.texture_img._version
+
+    def median_texture(self):
+        # texture_img with the unpainted texels set to the mean painted color, detached.
+        # Rebuilt only after texture_img changed
+        if self._median_texture is None or self._median_texture_version != self.texture_img._version:
+            painted, color_sum, n_painted = self.texture_stats()
+            with torch.no_grad():
+                self._median_texture = torch.where(painted.view(1, 1, *self.texture_img.shape[2:]),
+                                                   self.texture_img, (color_sum / n_painted).view(1, 3, 1, 1))
+            self._median_texture_version = self.texture_img._version
+        return self._median_texture
 
     def init_texture_map(self):
         cache_path = self.cache_path
+        max_iterations = 4
         if cache_path is None:
             cache_exists_flag = False
         else:
-            vt_cache, ft_cache = cache_path / 'vt.pth', cache_path / 'ft.pth'
+            # keyed on the unwrapped geometry and the unwrap options, meshes sharing a file stem do not collide
+            uv_key = utils.tensor_digest(self.mesh.vertices, self.mesh.faces.int(), max_iterations,
+                                         self.opt.parallel_unwrap)
+            vt_cache, ft_cache = cache_path / f'vt_{uv_key}.pth', cache_path / f'ft_{uv_key}.pth'
             cache_exists_flag = vt_cache.exists() and ft_cache.exists()
 
         if self.mesh.vt is not None and self.mesh.ft is not None \
                 and self.mesh.vt.shape[0] > 0 and self.mesh.ft.min() > -1:
-            vt = self.mesh.vt.cuda()
-            ft = self.mesh.ft.cuda()
-            run_xatlas = not (vt.shape[0] == self.mesh.vertices.shape[0] and ft.shape[0] == self.mesh.faces.shape[0])
-        elif cache_exists_flag:
-            vt = torch.load(vt_cache).cuda()
-            ft = torch.load(ft_cache).cuda()
+            vt = self.mesh.vt.to(self.device)
+            ft = self.mesh.ft.to(self.device)
             run_xatlas = not (vt.shape[0] == self.mesh.vertices.shape[0] and ft.shape[0] == self.mesh.faces.shape[0])
         else:
             run_xatlas = True
+        if run_xatlas and cache_exists_flag:
+            vt = torch.load(vt_cache).to(self.device)
+            ft = torch.load(ft_cache).to(self.device)
+            run_xatlas = False
 
         if run_xatlas:
-            logger.info('running xatlas to unwrap UVs for mesh: v={v_np.shape} f={f_np.shape}')
             # unwrap uvs
-            import xatlas
             v_np = self.mesh.vertices.cpu().numpy()
             f_np = self.mesh.faces.int().cpu().numpy()
-            atlas = xatlas.Atlas()
-            atlas.add_mesh(v_np, f_np)
-            chart_options = xatlas.ChartOptions()
-            chart_options.max_iterations = 4
-            atlas.generate(chart_options=chart_options)
-            vmapping, ft_np, vt_np = atlas[0]  # [N], [M, 3], [N, 2]
-
-            vt = torch.from_numpy(vt_np.astype(np.float32)).float().cuda()
-            ft = torch.from_numpy(ft_np.astype(np.int64)).int().cuda()
+            logger.info(f'running xatlas to unwrap UVs for mesh: v={v_np.shape} f={f_np.shape}')
+            if self.opt.parallel_unwrap:
+                vt_np, ft_np = parallel_unwrap(v_np, f_np, max_iterations=max_iterations,
+                                               workers=self.opt.unwrap_workers)
+            else:
+                vt_np, ft_np = xatlas_unwrap(v_np, f_np, max_iterations=max_iterations)
+
+            vt = torch.from_numpy(vt_np.astype(np.float32)).float().to(self.device)
+            ft = torch.from_numpy(ft_np.astype(np.int64)).int().to(self.device)
             if cache_path is not None:
                 os.makedirs(cache_path, exist_ok=True)
                 torch.save(vt.cpu(), vt_cache)
@@ -298,7 +556,7 @@ class TexturedMeshModel(nn.Module):
         return [self.background_sphere_colors, self.texture_img, self.meta_texture_img]
 
     @torch.no_grad()
-    def export_mesh(self, path):
+    def export_mesh(self, path, save_glb=False):
         v, f = self.mesh.vertices, self.mesh.faces.int()
         h0, w0 = 256, 256
         ssaa, name = 1, ''
@@ -326,24 +584,14 @@ class TexturedMeshModel(nn.Module):
         obj_file = os.path.join(path, f'{name}mesh.obj')
         mtl_file = os.path.join(path, f'{name}mesh.mtl')
 
-        logger.info('writing obj mesh to {obj_file}')
-        with open(obj_file, "w") as fp:
-            fp.write(f'mtllib {name}mesh.mtl \n')
-
-            logger.info('writing vertices {v_np.shape}')
-            for v in v_np:
-                fp.write(f'v {v[0]} {v[1]} {v[2]} \n')
+        logger.info(f'writing obj mesh to {obj_file}: v={v_np.shape} vt={vt_np.shape} f={f_np.shape}')
+        mesh_io.write_obj(obj_file, v_np, vt_np, f_np, ft_np, mtl_name=f'{name}mesh.mtl')
 
-            logger.info('writing vertices texture coords {vt_np.shape}')
-            for v in vt_np:
-                # fp.write(f'vt {v[0]} {1 - v[1]} \n')
-                fp.write(f'vt {v[0]} {v[1]} \n')
-
-            logger.info('writing faces {f_np.shape}')
-            fp.write(f'usemtl mat0 \n')
-            for i in range(len(f_np)):
-                fp.write(
-                    f"f {f_np[i, 0] + 1}/{ft_np[i, 0] + 1} {f_np[i, 1] + 1}/{ft_np[i, 1] + 1} {f_np[i, 2] + 1}/{ft_np[i, 2] + 1} \n")
+        if save_glb:
+            glb_file = os.path.join(path, f'{name}mesh.glb')
+            logger.info(f'writing glb mesh to {glb_file}')
+            with open(os.path.join(path, f'{name}albedo.png'), 'rb') as fp:
+                mesh_io.write_glb(glb_file, v_np, vt_np, f_np, ft_np, texture_png=fp.read())
 
         with open(mtl_file, "w") as fp:
             fp.write(f'newmtl mat0 \n')
@@ -355,76 +603,164 @@ class TexturedMeshModel(nn.Module):
             fp.write(f'Ns 0.000000 \n')
             fp.write(f'map_Kd {name}albedo.png \n')
 
+    def layer_texture(self, layer):
+        # texture image of a render layer: 'albedo', 'median' (albedo with the unpainted texels set to the median
+        # color) or 'meta'
+        if layer == 'meta':
+            return self.meta_texture_img
+        if layer == 'median':
+            return self.median_texture()
+        return self.texture_img
+
     def render(self, theta=None, phi=None, radius=None, background=None,
-               use_meta_texture=False, render_cache=None, use_median=False, dims=None):
+               use_meta_texture=False, render_cache=None, use_median=False, dims=None, lod=0, window=None,
+               z_normals_only=False, camera_transform=None):
+        layer = 'meta' if use_meta_texture else 'median' if use_median else 'albedo'
+        return self.render_layers({layer: background}, theta=theta, phi=phi, radius=radius, render_cache=render_cache,
+                                  dims=dims, lod=lod, window=window, z_normals_only=z_normals_only,
+                                  camera_transform=camera_transform)[layer]
+
+    def render_layers(self, layers, theta=None, phi=None, radius=None, render_cache=None, dims=None, lod=0,
+                      window=None, z_normals_only=False, camera_transform=None):
+        # renders several texture layers ({layer: background}, see layer_texture) with a single texture lookup over
+        # their stacked channels, returns the outputs of render for every layer.
+        # A camera_transform [1, 4, 3] replaces theta, phi and radius, such renders skip the G-buffer cache
+        # augmentations deform the full resolution mesh only
+        use_augmentations = self.augmentations and lod == 0
+        cache_key = None
         if render_cache is None:
-            assert theta is not None and phi is not None and radius is not None
-        background_sphere_colors = self.background_sphere_colors[
-            torch.randint(0, self.background_sphere_colors.shape[0], (1,))]
-        if use_meta_texture:
-            texture_img = self.meta_texture_img
-        else:
-            texture_img = self.texture_img
-
-        if self.augmentations:
-            augmented_vertices = self.augment_vertices()
-        else:
-            augmented_vertices = self.mesh.vertices
-
-        if use_median:
-            diff = (texture_img - torch.tensor(self.default_color).view(1, 3, 1, 1).to(
-                self.device)).abs().sum(axis=1)
-            default_mask = (diff < 0.1).float().unsqueeze(0)
-            median_color = texture_img[0, :].reshape(3, -1)[:, default_mask.flatten() == 0].mean(
-                axis=1)
-            texture_img = texture_img.clone()
-            with torch.no_grad():
-                texture_img.reshape(3, -1)[:, default_mask.flatten() == 1] = median_color.reshape(-1, 1)
-        background_type = 'none'
-        use_render_back = False
-        if background is not None and type(background) == str:
-            background_type = background
-            use_render_back = True
-        pred_features, mask, depth, normals, render_cache = self.renderer.render_single_view_texture(augmented_vertices,
-                                                                                                     self.mesh.faces,
-                                                                                                     self.face_attributes,
-                                                                                                     texture_img,
-                                                                                                     elev=theta,
-                                                                                                     azim=phi,
-                                                                                                     radius=radius,
-                                                                                                     look_at_height=self.dy,
-                                                                                                     render_cache=render_cache,
-                                                                                                     dims=dims,
-                                                                                                     background_type=background_type)
+            assert camera_transform is not None or (theta is not None and phi is not None and radius is not None)
+            if not use_augmentations and camera_transform is None:
+                cache_key = self.gbuffer_cache.view_key(theta, phi, radius,
+                                                        self.renderer.dim if dims is None else dims, lod, window)
+                render_cache = self.gbuffer_cache.get(cache_key)
+                if render_cache is not None:
+                    cache_key = None
+
+        vertices, faces, face_attributes, mesh_key = self.lod_geometry(lod)
+        if use_augmentations and render_cache is None:
+            vertices, mesh_key = self.augment_vertices(), None
+
+        textures = {layer: self.layer_texture(layer) for layer in layers}
+        texture_img = torch.cat(list(textures.values()), dim=1) if len(textures) > 1 else textures[next(iter(layers))]
+        features, mask, depth, normals, render_cache = self.renderer.render_single_view_texture(vertices,
+                                                                                               faces,
+                                                                                               face_attributes,
+                                                                                               texture_img,
+                                                                                               elev=theta,
+                                                                                               azim=phi,
+                                                                                               radius=radius,
+                                                                                               look_at_height=self.dy,
+                                                                                               render_cache=render_cache,
+                                                                                               dims=dims,
+                                                                                               background_type='none',
+                                                                                               mesh_key=mesh_key,
+                                                                                               window=window,
+                                                                                               z_normals_only=z_normals_only,
+                                                                                               camera_transform=camera_transform)
 
         mask = mask.detach()
 
-        if use_render_back:
-            pred_map = pred_features
-            pred_back = pred_features
-        else:
+        outputs = {}
+        channel = 0
+        for layer, background in layers.items():
+            n_channels = textures[layer].shape[1]
+            pred_features = features[:, channel:channel + n_channels]
+            channel += n_channels
+
             if background is None:
-                pred_back, _, _ = self.renderer.render_single_view(self.env_sphere,
-                                                                   background_sphere_colors,
-                                                                   elev=theta,
-                                                                   azim=phi,
-                                                                   radius=radius,
-                                                                   dims=dims,
-                                                                   look_at_height=self.dy, calc_depth=False)
+                background_sphere_colors = self.background_sphere_colors
+                if background_sphere_colors.shape[0] > 1:
+                    background_sphere_colors = background_sphere_colors[
+                        torch.randint(0, self.background_sphere_colors.shape[0], (1,))]
+                # the background sphere is rasterized once per camera, only the color lookup is repeated
+                if 'background_face_idx' not in render_cache:
+                    height, width = render_cache['face_idx'].shape[1:]
+                    render_cache.update(self.renderer.rasterize_background(self.env_sphere,
+                                                                           render_cache['camera_transform'],
+                                                                           dims=(width, height),
+                                                                           window=render_cache.get('window')))
+                pred_back = self.renderer.background_from_cache(render_cache, background_sphere_colors)
+            elif type(background) == str:
+                # same as the renderer background types, composited here since the layers share one lookup
+                if background == 'white':
+                    pred_back = self.renderer.white
+                elif background == 'random':
+                    pred_back = torch.rand((features.shape[0], n_channels, 1, 1), device=self.device)
+                else:
+                    pred_back = torch.zeros_like(self.renderer.white)
             elif len(background.shape) == 1:
-                pred_back = torch.ones_like(pred_features) * background.reshape(1, 3, 1, 1)
+                pred_back = background.reshape(1, 3, 1, 1).expand_as(pred_features)
             else:
                 pred_back = background
 
-            pred_map = pred_back * (1 - mask) + pred_features * mask
-
-        if not use_meta_texture:
-            pred_map = pred_map.clamp(0, 1)
-            pred_features = pred_features.clamp(0, 1)
-
-        return {'image': pred_map, 'mask': mask, 'background': pred_back,
-                'foreground': pred_features, 'depth': depth, 'normals': normals, 'render_cache': render_cache,
-                'texture_map': texture_img}
+            pred_map = torch.lerp(pred_back, pred_features, mask)
+            if type(background) == str:
+                # the string backgrounds are part of the foreground, as in the renderer
+                pred_features = pred_back = pred_map
+
+            if layer != 'meta':
+                pred_map = pred_map.clamp(0, 1)
+                pred_features = pred_features.clamp(0, 1)
+
+            outputs[layer] = {'image': pred_map, 'mask': mask, 'background': pred_back,
+                              'foreground': pred_features, 'depth': depth, 'normals': normals,
+                              'render_cache': render_cache, 'texture_map': textures[layer]}
+
+        if cache_key is not None:
+            self.gbuffer_cache.put(cache_key, render_cache)
+
+        return outputs
+
+    def object_window(self, theta, phi, radius, lod=0):
+        # image window tightly framing the object from this view, render with window=... to only rasterize it
+        vertices = self.lod_geometry(lod)[0]
+        camera_transform = self.renderer.get_cameras_from_views([theta], [phi], [radius], look_at_height=self.dy)
+        return self.renderer.object_windows(vertices, camera_transform)[0]
+
+    def texel_visibility(self, thetas, phis, radii, device='cpu'):
+        # [N, texture_resolution, texture_resolution] cosine of the view angle of every texel of texture_img from
+        # each view, 0 where the texel is not seen. Ray cast on device, no rendering involved
+        # resolved device, so that 'cuda' matches the cuda:0 of an existing BVH
+        device = torch.empty(0, device=device).device
+        if self._texel_visibility is None or self._texel_visibility.bvh.device != device:
+            self._texel_visibility = TexelVisibility(self.mesh.vertices, self.mesh.faces, self.vt, self.ft,
+                                                     self.texture_resolution, device=device)
+        camera_transforms = self.renderer.get_cameras_from_views(thetas, phis, radii, look_at_height=self.dy)
+        return self._texel_visibility(camera_transforms, self.renderer.camera_projection).to(self.device)
+
+    def rasterize_views(self, thetas, phis, radii, dims=None, lod=0, camera_transforms=None):
+        # batched render cache of the views, the views missing from the G-buffer cache are rasterized in batches of
+        # view_batch_size. Views given as camera_transforms [N, 4, 3] are always rasterized
+        vertices, faces, face_attributes, mesh_key = self.lod_geometry(lod)
+        if self.augmentations and lod == 0:
+            return self.renderer.rasterize_views(self.augment_vertices(), faces, face_attributes,
+                                                 thetas, phis, radii, look_at_height=self.dy, dims=dims,
+                                                 batch_size=self.view_batch_size,
+                                                 camera_transforms=camera_transforms)
+        if camera_transforms is not None:
+            return self.renderer.rasterize_views(vertices, faces, face_attributes, thetas, phis, radii,
+                                                 look_at_height=self.dy, dims=dims, batch_size=self.view_batch_size,
+                                                 mesh_key=mesh_key, camera_transforms=camera_transforms)
+
+        cache_dims = self.renderer.dim if dims is None else dims
+        cache_keys = [self.gbuffer_cache.view_key(theta, phi, radius, cache_dims, lod)
+                      for theta, phi, radius in zip(thetas, phis, radii)]
+        render_caches = [self.gbuffer_cache.get(cache_key) for cache_key in cache_keys]
+        missing = [i for i, render_cache in enumerate(render_caches) if render_cache is None]
+        if len(missing) > 0:
+            new_render_cache = self.renderer.rasterize_views(vertices, faces, face_attributes,
+                                                             [thetas[i] for i in missing],
+                                                             [phis[i] for i in missing],
+                                                             [radii[i] for i in missing],
+                                                             look_at_height=self.dy, dims=dims,
+                                                             batch_size=self.view_batch_size,
+                                                             mesh_key=mesh_key)
+            for i, render_cache in zip(missing, split_render_cache(new_render_cache)):
+                self.gbuffer_cache.put(cache_keys[i], render_cache)
+                render_caches[i] = render_cache
+
+        return cat_render_caches(render_caches)
 
     def draw(self, theta, phi, radius, target_rgb):
         # failed attempt to draw on the texture image
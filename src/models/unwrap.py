@@ -0,0 +1,113 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional, Tuple
+
+import numpy as np
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
+
+
+def xatlas_unwrap(vertices: np.ndarray, faces: np.ndarray, max_iterations: int = 4) -> Tuple[np.ndarray, np.ndarray]:
+    # vt [N, 2], ft [F, 3] of a single xatlas atlas
+    return _unwrap_job([(vertices, faces)], max_iterations)[0]
+
+
+def _unwrap_job(meshes: List[Tuple[np.ndarray, np.ndarray]], max_iterations: int) -> List[Tuple[np.ndarray, np.ndarray]]:
+    # charts and packs the meshes together in one atlas, top level so that it can run in a worker process
+    import xatlas
+    atlas = xatlas.Atlas()
+    for vertices, faces in meshes:
+        atlas.add_mesh(vertices, faces)
+    chart_options = xatlas.ChartOptions()
+    chart_options.max_iterations = max_iterations
+    atlas.generate(chart_options=chart_options)
+    uvs = []
+    for i in range(len(meshes)):
+        vmapping, ft, vt = atlas[i]  # [N], [M, 3], [N, 2]
+        uvs.append((vt.astype(np.float32), ft.astype(np.int64)))
+    return uvs
+
+
+def face_components(n_vertices: int, faces: np.ndarray) -> np.ndarray:
+    # connected component of every face
+    edges = np.concatenate([faces[:, [0, 1]], faces[:, [1, 2]]], axis=0)
+    adjacency = sparse.coo_matrix((np.ones(edges.shape[0]), (edges[:, 0], edges[:, 1])),
+                                  shape=(n_vertices, n_vertices))
+    _, vertex_labels = connected_components(adjacency, directed=False)
+    return vertex_labels[faces[:, 0]]
+
+
+def shelf_pack(sizes: np.ndarray, padding: float) -> Tuple[np.ndarray, float]:
+    # packs rectangles sizes [N, 2] on shelves of a square, tallest first.
+    # Returns their offsets [N, 2] and the scale that brings the layout into [0, 1]^2
+    padded = sizes + padding
+    shelf_width = max(np.sqrt(padded.prod(axis=1).sum()), padded[:, 0].max())
+    offsets = np.zeros_like(sizes)
+    x, y, shelf_height = 0.0, 0.0, 0.0
+    for i in np.argsort(-padded[:, 1]):
+        width, height = padded[i]
+        if x > 0 and x + width > shelf_width:
+            x, y, shelf_height = 0.0, y + shelf_height, 0.0
+        offsets[i] = x, y
+        x += width
+        shelf_height = max(shelf_height, height)
+    scale = 1 / max(shelf_width, y + shelf_height)
+    return offsets * scale, scale
+
+
+def parallel_unwrap(vertices: np.ndarray, faces: np.ndarray, max_iterations: int = 4, workers: Optional[int] = None,
+                    padding: float = 2 ** -8, job_faces: int = 2 ** 16) -> Tuple[np.ndarray, np.ndarray]:
+    # unwraps the disconnected components of the mesh in a process pool: components are grouped into jobs of about
+    # job_faces faces, every job is charted into its own atlas by xatlas, and the job atlases are scaled by the
+    # square root of their surface area (uniform texel density) and shelf packed into one uv square.
+    # The jobs only depend on the mesh, the same atlas comes out for any number of workers
+    workers = os.cpu_count() if workers is None else workers
+    labels = face_components(vertices.shape[0], faces)
+    n_components = labels.max() + 1
+    if n_components == 1:
+        return xatlas_unwrap(vertices, faces, max_iterations)
+
+    face_order = np.argsort(labels, kind='stable')
+    component_faces = np.split(face_order, np.cumsum(np.bincount(labels, minlength=n_components))[:-1])
+
+    # greedy balancing, largest components first
+    n_jobs = min(n_components, -(-faces.shape[0] // job_faces))
+    job_components = [[] for _ in range(n_jobs)]
+    job_loads = np.zeros(n_jobs)
+    for component in sorted(range(n_components), key=lambda c: -component_faces[c].shape[0]):
+        job = job_loads.argmin()
+        job_components[job].append(component)
+        job_loads[job] += component_faces[component].shape[0]
+
+    def component_mesh(component):
+        used_vertices, local_faces = np.unique(faces[component_faces[component]], return_inverse=True)
+        return vertices[used_vertices], local_faces.reshape(-1, 3).astype(np.uint32)
+
+    jobs = [[component_mesh(component) for component in components] for components in job_components]
+    if workers <= 1 or n_jobs == 1:
+        job_uvs = [_unwrap_job(job, max_iterations) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=min(workers, n_jobs)) as executor:
+            job_uvs = list(executor.map(_unwrap_job, jobs, [max_iterations] * n_jobs))
+
+    # each job atlas covers its uv bounding box, scaled to the surface area of the job
+    triangles = vertices[faces]
+    face_areas = np.linalg.norm(np.cross(triangles[:, 1] - triangles[:, 0], triangles[:, 2] - triangles[:, 0]), axis=1)
+    job_min, job_extent, job_sizes = np.zeros((n_jobs, 2)), np.zeros((n_jobs, 2)), np.zeros((n_jobs, 2))
+    for job, uvs in enumerate(job_uvs):
+        job_vt = np.concatenate([vt for vt, _ in uvs], axis=0)
+        job_min[job] = job_vt.min(axis=0)
+        job_extent[job] = np.maximum(job_vt.max(axis=0) - job_min[job], 1e-12)
+        area = sum(face_areas[component_faces[component]].sum() for component in job_components[job])
+        job_sizes[job] = job_extent[job] * np.sqrt(area / job_extent[job].prod())
+    offsets, scale = shelf_pack(job_sizes, padding * np.sqrt(face_areas.sum()))
+
+    vt, ft = [], np.zeros_like(faces, dtype=np.int64)
+    n_vt = 0
+    for job, uvs in enumerate(job_uvs):
+        job_scale = job_sizes[job] / job_extent[job] * scale
+        for component, (component_vt, component_ft) in zip(job_components[job], uvs):
+            vt.append((component_vt - job_min[job]) * job_scale + offsets[job])
+            ft[component_faces[component]] = component_ft + n_vt
+            n_vt += component_vt.shape[0]
+    return np.concatenate(vt, axis=0).astype(np.float32), ft
@@ -0,0 +1,161 @@
+import math
+
+import torch
+
+from . import rasterizer
+from .mesh import Mesh
+
+
+def _spread_bits(x: torch.Tensor) -> torch.Tensor:
+    # 10 bit integers -> every third bit of a 30 bit integer
+    x = (x | (x << 16)) & 0x030000FF
+    x = (x | (x << 8)) & 0x0300F00F
+    x = (x | (x << 4)) & 0x030C30C3
+    x = (x | (x << 2)) & 0x09249249
+    return x
+
+
+def morton_codes(points: torch.Tensor) -> torch.Tensor:
+    # 30 bit morton codes of points [N, 3], nearby points get nearby codes
+    min_corner = points.min(dim=0)[0]
+    extent = (points.max(dim=0)[0] - min_corner).clamp(min=1e-12)
+    cells = ((points - min_corner) / extent * 1023).long()
+    return (_spread_bits(cells[:, 0]) << 2) | (_spread_bits(cells[:, 1]) << 1) | _spread_bits(cells[:, 2])
+
+
+def ray_triangle_hits(origins, directions, triangles, t_min, t_max, eps=1e-12):
+    # Moller-Trumbore, origins / directions / t_min / t_max broadcast against triangles [..., 3, 3].
+    # True where the ray hits the triangle at t_min < t < t_max
+    v0, v1, v2 = triangles[..., 0, :], triangles[..., 1, :], triangles[..., 2, :]
+    e1, e2 = v1 - v0, v2 - v0
+    p = torch.cross(directions.expand_as(e2), e2, dim=-1)
+    det = (e1 * p).sum(dim=-1)
+    inv_det = 1 / torch.where(det.abs() > eps, det, torch.ones_like(det))
+    s = origins - v0
+    u = (s * p).sum(dim=-1) * inv_det
+    q = torch.cross(s, e1, dim=-1)
+    v = (directions * q).sum(dim=-1) * inv_det
+    t = (e2 * q).sum(dim=-1) * inv_det
+    return (det.abs() > eps) & (u >= 0) & (v >= 0) & (u + v <= 1) & (t > t_min) & (t < t_max)
+
+
+class MeshBVH:
+    # bounding volume hierarchy over the triangles of a mesh for batched any-hit ray queries, runs on any device.
+    # Triangles are sorted along a morton curve and grouped into leaves of leaf_size, the leaves are the bottom level
+    # of a complete binary tree stored implicitly (children of node i are 2i+1 and 2i+2).
+    # Rays are traversed together, level by level
+    def __init__(self, vertices: torch.Tensor, faces: torch.Tensor, leaf_size: int = 8, device='cpu'):
+        triangles = vertices.to(device)[faces.to(device).long()]
+        n_faces = triangles.shape[0]
+        order = morton_codes(triangles.mean(dim=1)).argsort()
+
+        self.leaf_size = leaf_size
+        self.depth = max(math.ceil(math.log2(max(math.ceil(n_faces / leaf_size), 1))), 0)
+        self.n_leaves = 2 ** self.depth
+        # the last leaves are filled up with copies of the last triangle, harmless for any-hit queries
+        padding = order[-1:].expand(self.n_leaves * leaf_size - n_faces)
+        self.triangles = triangles[torch.cat([order, padding])].view(self.n_leaves, leaf_size, 3, 3)
+
+        n_nodes = 2 * self.n_leaves - 1
+        self.box_min = self.triangles.new_zeros((n_nodes, 3))
+        self.box_max = self.triangles.new_zeros((n_nodes, 3))
+        self.box_min[self.n_leaves - 1:] = self.triangles.amin(dim=(1, 2))
+        self.box_max[self.n_leaves - 1:] = self.triangles.amax(dim=(1, 2))
+        for level in reversed(range(self.depth)):
+            nodes = torch.arange(2 ** level - 1, 2 ** (level + 1) - 1, device=device)
+            self.box_min[nodes] = torch.minimum(self.box_min[2 * nodes + 1], self.box_min[2 * nodes + 2])
+            self.box_max[nodes] = torch.maximum(self.box_max[2 * nodes + 1], self.box_max[2 * nodes + 2])
+
+    @property
+    def device(self):
+        return self.triangles.device
+
+    def occluded(self, origins: torch.Tensor, directions: torch.Tensor, t_min: torch.Tensor, t_max: torch.Tensor,
+                 ray_chunk_size: int = 2 ** 14) -> torch.Tensor:
+        # True for the rays origins + t * directions [R, 3] that hit a triangle at t_min < t < t_max
+        occluded = torch.zeros(origins.shape[0], dtype=torch.bool, device=self.device)
+        for start in range(0, origins.shape[0], ray_chunk_size):
+            rays = slice(start, start + ray_chunk_size)
+            occluded[rays] = self._occluded(origins[rays].to(self.device), directions[rays].to(self.device),
+                                            t_min[rays].to(self.device), t_max[rays].to(self.device))
+        return occluded
+
+    def _occluded(self, origins, directions, t_min, t_max):
+        # avoid 0 * inf in the slab test
+        directions_safe = torch.where(directions.abs() > 1e-12, directions, torch.full_like(directions, 1e-12))
+        inv_directions = 1 / directions_safe
+
+        # (ray, node) pairs still to be visited, breadth first
+        rays = torch.arange(origins.shape[0], device=self.device)
+        nodes = torch.zeros_like(rays)
+        children = torch.tensor([1, 2], device=self.device)
+        for level in range(self.depth + 1):
+            t0 = (self.box_min[nodes] - origins[rays]) * inv_directions[rays]
+            t1 = (self.box_max[nodes] - origins[rays]) * inv_directions[rays]
+            t_near = torch.maximum(torch.minimum(t0, t1).amax(dim=-1), t_min[rays])
+            t_far = torch.minimum(torch.maximum(t0, t1).amin(dim=-1), t_max[rays])
+            hit_box = t_near <= t_far
+            rays, nodes = rays[hit_box], nodes[hit_box]
+            if level < self.depth:
+                rays = rays.repeat_interleave(2)
+                nodes = (2 * nodes[:, None] + children).flatten()
+
+        leaves = nodes - (self.n_leaves - 1)
+        hits = ray_triangle_hits(origins[rays][:, None], directions[rays][:, None], self.triangles[leaves],
+                                 t_min[rays][:, None], t_max[rays][:, None]).any(dim=-1)
+        occluded = torch.zeros(origins.shape[0], dtype=torch.bool, device=self.device)
+        occluded[rays[hits]] = True
+        return occluded
+
+
+class TexelVisibility:
+    # texel space visibility of a textured mesh: the surface point and normal behind every texel of a
+    # resolution x resolution texture are found once by rasterizing the uv layout, cameras are then answered by
+    # casting one ray per texel through a MeshBVH, independently of any render resolution
+    def __init__(self, vertices: torch.Tensor, faces: torch.Tensor, vt: torch.Tensor, ft: torch.Tensor,
+                 resolution: int, device='cpu', eps=1e-4):
+        vertices, faces = vertices.to(device), faces.to(device).long()
+        self.resolution = resolution
+        self.eps = eps
+        self.bvh = MeshBVH(vertices, faces, device=device)
+
+        # image y of the rasterizer points up like v, so rows match the rows of the texture image
+        face_uvs = vt.to(device)[ft.to(device).long()].unsqueeze(0) * 2 - 1
+        face_normals, _ = Mesh.calculate_face_normals(vertices, faces)
+        face_features = torch.cat([vertices[faces], face_normals[:, None, :].expand(-1, 3, -1)], dim=-1)
+        with torch.no_grad():
+            texel_features, texel_face_idx = rasterizer.rasterize(resolution, resolution,
+                                                                  torch.zeros_like(face_uvs[..., 0]), face_uvs,
+                                                                  face_features.unsqueeze(0))
+        self.texel_mask = texel_face_idx[0] > -1
+        self.positions = texel_features[0][self.texel_mask][:, :3]
+        self.normals = torch.nn.functional.normalize(texel_features[0][self.texel_mask][:, 3:], dim=-1)
+
+    def __call__(self, camera_transforms: torch.Tensor, camera_projection: torch.Tensor) -> torch.Tensor:
+        # cosine between the texel normal and the direction to the camera for N cameras [N, 4, 3]
+        # (kaolin convention, see Renderer.get_camera_from_view), 0 where the texel is not seen: off the surface,
+        # back facing, outside the view frustum or occluded. Returns [N, resolution, resolution]
+        camera_transforms = camera_transforms.to(self.bvh.device)
+        camera_projection = camera_projection.to(self.bvh.device).reshape(-1)
+        visibility = self.positions.new_zeros((camera_transforms.shape[0], self.resolution, self.resolution))
+        for i, camera_transform in enumerate(camera_transforms):
+            rotation, translation = camera_transform[:3], camera_transform[3]
+            camera_position = -translation @ rotation.T
+
+            to_camera = camera_position - self.positions
+            distance = to_camera.norm(dim=-1)
+            to_camera = to_camera / distance[:, None]
+            cosine = (self.normals * to_camera).sum(dim=-1)
+
+            # the camera looks down -z, project like kaolin's perspective_camera
+            points_camera = self.positions @ rotation + translation
+            projected = points_camera * camera_projection
+            image = projected[:, :2] / projected[:, 2:]
+            candidates = ((cosine > 0) & (points_camera[:, 2] < 0) & (image.abs() <= 1).all(dim=-1)).nonzero()[:, 0]
+
+            occluded = self.bvh.occluded(self.positions[candidates], to_camera[candidates],
+                                         torch.full_like(distance[candidates], self.eps), distance[candidates])
+            texel_cosine = torch.zeros_like(cosine)
+            texel_cosine[candidates[~occluded]] = cosine[candidates[~occluded]]
+            visibility[i][self.texel_mask] = texel_cosine
+        return visibility
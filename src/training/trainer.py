@@ -17,7 +17,7 @@ from tqdm import tqdm
 
 from src import utils
 from src.configs.train_config import TrainConfig
-from src.models.textured_mesh import TexturedMeshModel
+from src.models.textured_mesh import TexturedMeshModel, texel_taps
 from src.stable_diffusion_depth import StableDiffusion
 from src.stable_diffusion_depth_control import StableDiffusionControl
 from src.training.views_dataset import ViewsDataset, MultiviewDataset
@@ -43,6 +43,7 @@ class TEXTure:
         pyrallis.dump(self.cfg, (self.exp_path / 'config.yaml').open('w'))
 
         self.view_dirs = ['front', 'left', 'back', 'right', 'overhead', 'bottom']
+        self.black_background = torch.zeros(3, device=self.device)
         self.mesh_model = self.init_mesh_model()
         self.diffusion = self.init_diffusion()
         self.text_z, self.text_string = self.calc_text_embeddings()
@@ -60,7 +61,17 @@ class TEXTure:
                                   render_grid_size=self.cfg.render.train_grid_size,
                                   cache_path=cache_path,
                                   texture_resolution=self.cfg.guide.texture_resolution,
-                                  augmentations=False)
+                                  augmentations=False,
+                                  view_batch_size=self.cfg.render.view_batch_size,
+                                  gbuffer_cache_bytes=self.cfg.render.gbuffer_cache_mb * 2 ** 20,
+                                  gbuffer_cache_half=self.cfg.render.gbuffer_cache_half,
+                                  disk_gbuffer_cache=self.cfg.render.disk_gbuffer_cache,
+                                  render_tile_size=self.cfg.render.render_tile_size,
+                                  cull_faces=self.cfg.render.cull_faces,
+                                  lod_grid_sizes=self.cfg.render.lod_grid_sizes,
+                                  rasterizer=self.cfg.render.rasterizer,
+                                  face_chunk_size=self.cfg.render.large_mesh_chunk_size
+                                  if self.cfg.render.large_mesh else None)
 
         model = model.to(self.device)
         logger.info(
@@ -120,7 +131,7 @@ class TEXTure:
     def paint(self):
         logger.info('Starting training ^_^')
         # Evaluate the initialization
-        self.evaluate(self.dataloaders['val'], self.eval_renders_path)
+        self.evaluate(self.dataloaders['val'], self.eval_renders_path, lod=self.cfg.render.eval_lod)
         self.mesh_model.train()
 
         pbar = tqdm(total=len(self.dataloaders['train']), initial=self.paint_step,
@@ -130,7 +141,7 @@ class TEXTure:
             self.paint_step += 1
             pbar.update(1)
             self.paint_viewpoint(data)
-            self.evaluate(self.dataloaders['val'], self.eval_renders_path)
+            self.evaluate(self.dataloaders['val'], self.eval_renders_path, lod=self.cfg.render.eval_lod)
             self.mesh_model.train()
 
         self.mesh_model.change_default_to_median()
@@ -139,27 +150,31 @@ class TEXTure:
         self.full_eval()
         logger.info('\tDone!')
 
-    def evaluate(self, dataloader: DataLoader, save_path: Path, save_as_video: bool = False):
+    def evaluate(self, dataloader: DataLoader, save_path: Path, save_as_video: bool = False, lod: int = 0):
         logger.info(f'Evaluating and saving model, painting iteration #{self.paint_step}...')
         self.mesh_model.eval()
         save_path.mkdir(exist_ok=True)
 
         if save_as_video:
             all_preds = []
-        for i, data in enumerate(dataloader):
-            preds, textures, depths, normals = self.eval_render(data)
-
-            pred = tensor2numpy(preds[0])
-
-            if save_as_video:
-                all_preds.append(pred)
-            else:
-                Image.fromarray(pred).save(save_path / f"step_{self.paint_step:05d}_{i:04d}_rgb.jpg")
-                Image.fromarray((cm.seismic(normals[0, 0].cpu().numpy())[:, :, :3] * 255).astype(np.uint8)).save(
-                    save_path / f'{self.paint_step:04d}_{i:04d}_normals_cache.jpg')
-                if self.paint_step == 0:
-                    # Also save depths for debugging
-                    torch.save(depths[0], save_path / f"{i:04d}_depth.pt")
+        views = list(dataloader)
+        batch_size = self.cfg.render.view_batch_size
+        for start in range(0, len(views), batch_size):
+            preds, textures, depths, normals = self.eval_render(views[start:start + batch_size], lod=lod)
+
+            for j in range(preds.shape[0]):
+                i = start + j
+                pred = tensor2numpy(preds[j])
+
+                if save_as_video:
+                    all_preds.append(pred)
+                else:
+                    Image.fromarray(pred).save(save_path / f"step_{self.paint_step:05d}_{i:04d}_rgb.jpg")
+                    Image.fromarray((cm.seismic(normals[j, 0].cpu().numpy())[:, :, :3] * 255).astype(np.uint8)).save(
+                        save_path / f'{self.paint_step:04d}_{i:04d}_normals_cache.jpg')
+                    if self.paint_step == 0:
+                        # Also save depths for debugging
+                        torch.save(depths[j], save_path / f"{i:04d}_depth.pt")
 
         # Texture map is the same, so just take the last result
         texture = tensor2numpy(textures[0])
@@ -178,7 +193,7 @@ class TEXTure:
     def full_eval(self, output_dir: Path = None):
         if output_dir is None:
             output_dir = self.final_renders_path
-        self.evaluate(self.dataloaders['val_large'], output_dir, save_as_video=True)
+        self.evaluate(self.dataloaders['val_large'], output_dir, save_as_video=True, lod=self.cfg.render.video_lod)
         # except:
         #     logger.error('failed to save result video')
 
@@ -186,7 +201,7 @@ class TEXTure:
             save_path = make_path(self.exp_path / 'mesh')
             logger.info(f"Saving mesh to {save_path}")
 
-            self.mesh_model.export_mesh(save_path)
+            self.mesh_model.export_mesh(save_path, save_glb=self.cfg.log.save_glb)
 
             logger.info(f"\tDone!")
 
@@ -198,26 +213,36 @@ class TEXTure:
         phi = float(phi + 2 * np.pi if phi < 0 else phi)
         logger.info(f'Painting from theta: {theta}, phi: {phi}, radius: {radius}')
 
+        window, dims = None, None
+        if self.cfg.render.crop_adaptive:
+            # Only rasterize the object's bounding box, directly at the crop resolution
+            window = self.mesh_model.object_window(theta, phi, radius)
+            dims = (self.cfg.render.crop_render_size, self.cfg.render.crop_render_size)
+
         # Set background image
         if self.cfg.guide.use_background_color:
             background = torch.Tensor([0, 0.8, 0]).to(self.device)
+        elif window is not None:
+            background = utils.crop_to_window(self.back_im.unsqueeze(0), window, self.cfg.render.crop_render_size)
         else:
             background = F.interpolate(self.back_im.unsqueeze(0),
                                        (self.cfg.render.train_grid_size, self.cfg.render.train_grid_size),
                                        mode='bilinear', align_corners=False)
 
-        # Render from viewpoint
-        outputs = self.mesh_model.render(theta=theta, phi=phi, radius=radius, background=background)
+        # Render from viewpoint, the raw, median and meta textures are sampled together
+        # Use the median value as rgb, we shouldn't have color leakage, but just in case
+        rgb_layer = 'median' if self.paint_step > 1 else 'albedo'
+        layer_outputs = self.mesh_model.render_layers({'albedo': background, rgb_layer: background,
+                                                       'meta': self.black_background},
+                                                      theta=theta, phi=phi, radius=radius, dims=dims, window=window,
+                                                      z_normals_only=True)
+        outputs = layer_outputs[rgb_layer]
         render_cache = outputs['render_cache']
-        rgb_render_raw = outputs['image']  # Render where missing values have special color
+        rgb_render_raw = layer_outputs['albedo']['image']  # Render where missing values have special color
         depth_render = outputs['depth']
-        # Render again with the median value to use as rgb, we shouldn't have color leakage, but just in case
-        outputs = self.mesh_model.render(background=background,
-                                         render_cache=render_cache, use_median=self.paint_step > 1)
         rgb_render = outputs['image']
-        # Render meta texture map
-        meta_output = self.mesh_model.render(background=torch.Tensor([0, 0, 0]).to(self.device),
-                                             use_meta_texture=True, render_cache=render_cache)
+        # Meta texture map
+        meta_output = layer_outputs['meta']
 
         z_normals = outputs['normals'][:, -1:, :, :].clamp(0, 1)
         z_normals_cache = meta_output['image'].clamp(0, 1)
@@ -254,7 +279,11 @@ class TEXTure:
         self.log_train_image(rgb_render * refine_mask, name='refine_regions')
 
         # Crop to inner region based on object mask
-        min_h, min_w, max_h, max_w = utils.get_nonzero_region(outputs['mask'][0, 0])
+        if window is None:
+            min_h, min_w, max_h, max_w = utils.get_nonzero_region(outputs['mask'][0, 0])
+        else:
+            # The render already is the crop
+            min_h, min_w, max_h, max_w = 0, 0, dims[1], dims[0]
         crop = lambda x: x[:, :, min_h:max_h, min_w:max_w]
         cropped_rgb_render = crop(rgb_render)
         cropped_depth_render = crop(depth_render)
@@ -297,33 +326,31 @@ class TEXTure:
 
         return
 
-    def eval_render(self, data):
-        theta = data['theta']
-        phi = data['phi']
-        radius = data['radius']
-        phi = phi - np.deg2rad(self.cfg.render.front_offset)
-        phi = float(phi + 2 * np.pi if phi < 0 else phi)
+    def eval_render(self, views: List[Dict[str, Any]], lod: int = 0):
+        # Render a batch of eval views together
+        thetas = np.array([data['theta'] for data in views])
+        phis = np.array([data['phi'] for data in views])
+        radii = [data['radius'] for data in views]
+        phis = phis - np.deg2rad(self.cfg.render.front_offset)
+        phis = np.where(phis < 0, phis + 2 * np.pi, phis).tolist()
+        thetas = thetas.tolist()
         dim = self.cfg.render.eval_grid_size
-        outputs = self.mesh_model.render(theta=theta, phi=phi, radius=radius,
-                                         dims=(dim, dim), background='white')
+        render_cache = self.mesh_model.rasterize_views(thetas, phis, radii, dims=(dim, dim), lod=lod)
+        layer_outputs = self.mesh_model.render_layers({'albedo': 'white', 'meta': self.black_background},
+                                                      render_cache=render_cache, z_normals_only=True)
+        outputs = layer_outputs['albedo']
         z_normals = outputs['normals'][:, -1:, :, :].clamp(0, 1)
         rgb_render = outputs['image']  # .permute(0, 2, 3, 1).contiguous().clamp(0, 1)
-        diff = (rgb_render.detach() - torch.tensor(self.mesh_model.default_color).view(1, 3, 1, 1).to(
-            self.device)).abs().sum(axis=1)
-        uncolored_mask = (diff < 0.1).float().unsqueeze(0)
+        diff = (rgb_render.detach() - self.mesh_model.default_color_tensor).abs().sum(axis=1)
+        uncolored_mask = (diff < 0.1).float().unsqueeze(1)
         rgb_render = rgb_render * (1 - uncolored_mask) + utils.color_with_shade([0.85, 0.85, 0.85], z_normals=z_normals,
                                                                                 light_coef=0.3) * uncolored_mask
 
-        outputs_with_median = self.mesh_model.render(theta=theta, phi=phi, radius=radius,
-                                                     dims=(dim, dim), use_median=True,
-                                                     render_cache=outputs['render_cache'])
-
-        meta_output = self.mesh_model.render(theta=theta, phi=phi, radius=radius,
-                                             background=torch.Tensor([0, 0, 0]).to(self.device),
-                                             use_meta_texture=True, render_cache=outputs['render_cache'])
+        meta_output = layer_outputs['meta']
         pred_z_normals = meta_output['image'][:, :1].detach()
         rgb_render = rgb_render.permute(0, 2, 3, 1).contiguous().clamp(0, 1).detach()
-        texture_rgb = outputs_with_median['texture_map'].permute(0, 2, 3, 1).contiguous().clamp(0, 1).detach()
+        # only the median texture map itself is logged, it is not rendered
+        texture_rgb = self.mesh_model.layer_texture('median').permute(0, 2, 3, 1).contiguous().clamp(0, 1).detach()
         depth_render = outputs['depth'].permute(0, 2, 3, 1).contiguous().detach()
 
         return rgb_render, texture_rgb, depth_render, pred_z_normals
@@ -332,8 +359,7 @@ class TEXTure:
                          depth_render: torch.Tensor,
                          z_normals: torch.Tensor, z_normals_cache: torch.Tensor, edited_mask: torch.Tensor,
                          mask: torch.Tensor):
-        diff = (rgb_render_raw.detach() - torch.tensor(self.mesh_model.default_color).view(1, 3, 1, 1).to(
-            self.device)).abs().sum(axis=1)
+        diff = (rgb_render_raw.detach() - self.mesh_model.default_color_tensor).abs().sum(axis=1)
         exact_generate_mask = (diff < 0.1).float().unsqueeze(0)
 
         # Extend mask
@@ -445,13 +471,31 @@ class TEXTure:
         # Update the normals
         z_normals_cache[:, 0, :, :] = torch.max(z_normals_cache[:, 0, :, :], z_normals[:, 0, :, :])
 
-        optimizer = torch.optim.Adam(self.mesh_model.get_params(), lr=self.cfg.optim.lr, betas=(0.9, 0.99),
-                                     eps=1e-15)
+        # only the texels read by the masked pixels can change, the painted texel statistics are updated for them
+        uv = render_cache['uv_features'].reshape(-1, 2)[render_update_mask.flatten() > 0]
+        texel_idx, _ = texel_taps(uv, *self.mesh_model.texture_img.shape[2:],
+                                  mode=self.cfg.guide.texture_interpolation_mode)
+
+        sparse = self.cfg.optim.sparse_projection and self.cfg.guide.texture_interpolation_mode != 'bicubic' \
+                 and isinstance(background, torch.Tensor)
+        with self.mesh_model.texture_update(texel_idx.flatten()):
+            if sparse:
+                rgb_render, current_z_normals = self.fit_texture_sparse(render_cache, background, rgb_output,
+                                                                        render_update_mask, z_normals_cache)
+            else:
+                optimizer = torch.optim.Adam(self.mesh_model.get_params(), lr=self.cfg.optim.lr, betas=(0.9, 0.99),
+                                             eps=1e-15)
+                rgb_render, current_z_normals = self.fit_texture(optimizer, render_cache, background, rgb_output,
+                                                                 render_update_mask, z_normals_cache)
+        return rgb_render, current_z_normals
+
+    def fit_texture(self, optimizer, render_cache: Dict[str, Any], background: Any, rgb_output: torch.Tensor,
+                    render_update_mask: torch.Tensor, z_normals_cache: torch.Tensor):
         for _ in tqdm(range(200), desc='fitting mesh colors'):
             optimizer.zero_grad()
-            outputs = self.mesh_model.render(background=background,
-                                             render_cache=render_cache)
-            rgb_render = outputs['image']
+            layer_outputs = self.mesh_model.render_layers({'albedo': background, 'meta': self.black_background},
+                                                          render_cache=render_cache, z_normals_only=True)
+            rgb_render = layer_outputs['albedo']['image']
 
             mask = render_update_mask.flatten()
             masked_pred = rgb_render.reshape(1, rgb_render.shape[1], -1)[:, :, mask > 0]
@@ -460,8 +504,7 @@ class TEXTure:
             loss = ((masked_pred - masked_target.detach()).pow(2) * masked_mask).mean() + (
                     (masked_pred - masked_pred.detach()).pow(2) * (1 - masked_mask)).mean()
 
-            meta_outputs = self.mesh_model.render(background=torch.Tensor([0, 0, 0]).to(self.device),
-                                                  use_meta_texture=True, render_cache=render_cache)
+            meta_outputs = layer_outputs['meta']
             current_z_normals = meta_outputs['image']
             current_z_mask = meta_outputs['mask'].flatten()
             masked_current_z_normals = current_z_normals.reshape(1, current_z_normals.shape[1], -1)[:, :,
@@ -474,6 +517,61 @@ class TEXTure:
 
         return rgb_render, current_z_normals
 
+    def fit_texture_sparse(self, render_cache: Dict[str, Any], background: torch.Tensor, rgb_output: torch.Tensor,
+                           render_update_mask: torch.Tensor, z_normals_cache: torch.Tensor):
+        # same fit as fit_texture, but only the texels read by the fitted pixels are optimized, as compact tensors
+        # sampled directly at the cached uvs and scattered back into the texture maps at the end.
+        # The step cost and the optimizer state follow the number of visible texels, not the texture resolution
+        height, width = self.mesh_model.texture_img.shape[2:]
+        mode = self.cfg.guide.texture_interpolation_mode
+        uv = render_cache['uv_features'][0].reshape(-1, 2)
+        object_mask = (render_cache['face_idx'][0] > -1).flatten()
+        mask = render_update_mask.flatten()
+        rgb_pixels = (mask > 0).nonzero()[:, 0]
+        meta_pixels = object_mask.nonzero()[:, 0]
+
+        def compact_taps(pixels):
+            texel_idx, weights = texel_taps(uv[pixels], height, width, mode=mode)
+            texels, compact_idx = torch.unique(texel_idx, return_inverse=True)
+            return texels, compact_idx, weights
+
+        rgb_texels, rgb_idx, rgb_weights = compact_taps(rgb_pixels)
+        meta_texels, meta_idx, meta_weights = compact_taps(meta_pixels)
+        texture = self.mesh_model.texture_img.reshape(3, -1)
+        meta_texture = self.mesh_model.meta_texture_img.reshape(3, -1)
+        # only the first meta channel is fitted
+        rgb_params = texture[:, rgb_texels].detach().clone().requires_grad_(True)
+        meta_params = meta_texture[:1, meta_texels].detach().clone().requires_grad_(True)
+
+        if len(background.shape) == 1:
+            rgb_background = background.reshape(3, 1)
+        else:
+            rgb_background = background.reshape(3, -1)[:, rgb_pixels]
+        pixel_mask = object_mask[rgb_pixels].float()
+        masked_target = rgb_output.reshape(rgb_output.shape[1], -1)[:, rgb_pixels].unsqueeze(0)
+        masked_mask = mask[rgb_pixels]
+        masked_last_z_normals = z_normals_cache.reshape(z_normals_cache.shape[1], -1)[:1, meta_pixels]
+
+        optimizer = torch.optim.Adam([rgb_params, meta_params], lr=self.cfg.optim.lr, betas=(0.9, 0.99), eps=1e-15)
+        for _ in tqdm(range(200), desc='fitting mesh colors'):
+            optimizer.zero_grad()
+            rgb_features = (rgb_params[:, rgb_idx] * rgb_weights).sum(dim=-1)
+            masked_pred = torch.lerp(rgb_background, rgb_features, pixel_mask).clamp(0, 1).unsqueeze(0)
+            loss = ((masked_pred - masked_target.detach()).pow(2) * masked_mask).mean() + (
+                    (masked_pred - masked_pred.detach()).pow(2) * (1 - masked_mask)).mean()
+
+            masked_current_z_normals = (meta_params[:, meta_idx] * meta_weights).sum(dim=-1)
+            loss += (masked_current_z_normals - masked_last_z_normals.detach()).pow(2).mean()
+            loss.backward()
+            optimizer.step()
+
+        with torch.no_grad():
+            texture[:, rgb_texels] = rgb_params
+            meta_texture[:1, meta_texels] = meta_params
+            layer_outputs = self.mesh_model.render_layers({'albedo': background, 'meta': self.black_background},
+                                                          render_cache=render_cache, z_normals_only=True)
+        return layer_outputs['albedo']['image'], layer_outputs['meta']['image']
+
     def log_train_image(self, tensor: torch.Tensor, name: str, colormap=False):
         if self.cfg.log.log_images:
             if colormap:
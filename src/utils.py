@@ -1,5 +1,7 @@
+import hashlib
 import random
 import os
+import shutil
 from pathlib import Path
 from typing import List
 
@@ -10,6 +12,7 @@ from PIL import Image
 import einops
 from matplotlib import cm
 import torch.nn.functional as F
+from loguru import logger
 
 
 def get_view_direction(thetas, phis, overhead, front):
@@ -52,6 +55,60 @@ def make_path(path: Path) -> Path:
 
 
 
+def tensor_digest(*items) -> str:
+    # content hash of tensors, arrays and plain values, used as a cache key
+    digest = hashlib.sha1()
+    for item in items:
+        if isinstance(item, torch.Tensor):
+            item = item.detach().cpu().numpy()
+        if isinstance(item, np.ndarray):
+            digest.update(str((item.dtype, item.shape)).encode())
+            digest.update(np.ascontiguousarray(item))
+        else:
+            digest.update(repr(item).encode())
+    return digest.hexdigest()
+
+
+def atomic_write(path: Path, write) -> bool:
+    # write(tmp_path) writes a file or directory next to path, which then replaces path in a single rename so that
+    # readers never see partial writes. Failures are only logged, another process may have written path already
+    path = Path(path)
+    tmp_path = path.with_name(f'{path.stem}.tmp{os.getpid()}{path.suffix}')
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        write(tmp_path)
+        os.replace(tmp_path, path)
+        return True
+    except OSError as e:
+        logger.warning(f'could not write {path}: {e}')
+        if tmp_path.is_dir():
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        elif tmp_path.exists():
+            tmp_path.unlink()
+        return False
+
+
+def atomic_save_arrays(path: Path, arrays: dict) -> bool:
+    # directory of {name}.npy files, written with atomic_write
+    def write(tmp_path):
+        tmp_path.mkdir()
+        for name, array in arrays.items():
+            if isinstance(array, torch.Tensor):
+                array = array.detach().cpu().numpy()
+            np.save(tmp_path / f'{name}.npy', array)
+
+    return atomic_write(path, write)
+
+
+def load_arrays(path: Path, names: List[str]):
+    # copy-on-write memory maps of arrays saved with atomic_save_arrays, only read from disk when they are used.
+    # None when path does not exist
+    path = Path(path)
+    if not path.exists():
+        return None
+    return {name: np.load(path / f'{name}.npy', mmap_mode='c') for name in names}
+
+
 def save_colormap(tensor: torch.Tensor, path: Path):
     Image.fromarray((cm.seismic(tensor.cpu().numpy())[:, :, :3] * 255).astype(np.uint8)).save(path)
 
@@ -94,6 +151,17 @@ def get_nonzero_region(mask:torch.Tensor):
     return min_h, min_w, max_h, max_w
 
 
+def crop_to_window(image: torch.Tensor, window: torch.Tensor, size: int) -> torch.Tensor:
+    # resample the part of image [B, C, H, W] under the image-plane window (x_min, y_min, x_max, y_max),
+    # where the image spans [-1, 1]^2 with y pointing up, to size x size
+    x_min, y_min, x_max, y_max = [float(w) for w in window]
+    theta = torch.tensor([[(x_max - x_min) / 2, 0, (x_min + x_max) / 2],
+                          [0, (y_max - y_min) / 2, -(y_min + y_max) / 2]], device=image.device).unsqueeze(0)
+    grid = F.affine_grid(theta.expand(image.shape[0], -1, -1), [image.shape[0], image.shape[1], size, size],
+                         align_corners=False)
+    return F.grid_sample(image, grid, mode='bilinear', padding_mode='border', align_corners=False)
+
+
 def gaussian_fn(M, std):
     n = torch.arange(0, M) - (M - 1.0) / 2.0
     sig2 = 2 * std * std
@@ -112,7 +180,7 @@ def gaussian_blur(image:torch.Tensor, kernel_size:int, std:int) -> torch.Tensor:
     gaussian_filter /= gaussian_filter.sum()
 
     image = F.conv2d(image,
-                                          gaussian_filter.unsqueeze(0).unsqueeze(0).cuda(), padding=kernel_size // 2)
+                                          gaussian_filter.unsqueeze(0).unsqueeze(0).to(image.device), padding=kernel_size // 2)
     return image
 
 def color_with_shade(color: List[float],z_normals:torch.Tensor,light_coef=0.7):